@@ -1,4 +1,5 @@
 import os
+from fractions import Fraction
 from gettext import gettext as _
 
 from gi.repository import Gtk
@@ -13,6 +14,7 @@ from applicationwindow import ApplicationWindow
 from xsheet import XSheet
 from canvasgraph import CanvasGraph
 from metronome import Metronome
+from journal import Journal
 from settings import get_settings
 from giutils import set_base_value, get_base_value, set_base_color
 
@@ -32,7 +34,11 @@ class Application(Gtk.Application):
         self._set_default_settings()
 
         self._xsheet = XSheet()
+        self._xsheet.fps = _settings['play']['fps']
+        self._xsheet.coalesce_signals = True
         self._xsheet.connect("cursor-changed", self._cursor_changed_cb)
+        self._xsheet.history.set_budget(_settings['history']['budget'],
+                                        _settings['history']['compress'])
         self._canvas_graph = CanvasGraph(self._xsheet)
         self._metronome = Metronome(self._xsheet)
 
@@ -42,6 +48,11 @@ class Application(Gtk.Application):
         if os.path.exists('test.zip'):
             self._xsheet.load('test.zip')
 
+        # Recover the edits made after the last save, if any.
+        journal = Journal('test.zip.journal')
+        journal.replay(self._xsheet, _settings['brush'])
+        self._xsheet.journal = journal
+
     def _activate_cb(self, app):
         self.setup()
         self._main_window.present()
@@ -58,6 +69,15 @@ class Application(Gtk.Application):
     def _new_cb(self, action, state):
         self._xsheet.new()
 
+    def _save_cb(self, action, state):
+        self._xsheet.save_async('test.zip', _settings['save']['workers'])
+
+    def _undo_cb(self, action, state):
+        self._xsheet.undo()
+
+    def _redo_cb(self, action, state):
+        self._xsheet.redo()
+
     def _cut_cb(self, action, state):
         self._xsheet.cut()
 
@@ -70,6 +90,21 @@ class Application(Gtk.Application):
     def _remove_clear_cb(self, action, state):
         self._xsheet.remove_clear()
 
+    def _insert_frame_cb(self, action, state):
+        self._xsheet.insert_frames()
+
+    def _delete_frame_cb(self, action, state):
+        self._xsheet.delete_frames()
+
+    def _set_loop_in_cb(self, action, state):
+        self._xsheet.set_loop_in()
+
+    def _set_loop_out_cb(self, action, state):
+        self._xsheet.set_loop_out()
+
+    def _clear_loop_cb(self, action, state):
+        self._xsheet.clear_loop()
+
     def _next_frame_cb(self, action, state):
         self._xsheet.next_frame()
 
@@ -153,7 +188,7 @@ class Application(Gtk.Application):
         action.set_state(state)
 
     def _quit(self):
-        self._xsheet.save('test.zip')
+        self._xsheet.save('test.zip', _settings['save']['workers'])
         Gtk.Application.quit(self)
 
     def _set_default_settings(self):
@@ -176,6 +211,16 @@ class Application(Gtk.Application):
 
         _settings['play'] = {}
         _settings['play']['loop'] = False
+        # Projects saved with a frame rate play at their own.
+        _settings['play']['fps'] = Fraction(24)
+        _settings['play']['cache'] = 512 * 1024 * 1024
+
+        _settings['save'] = {}
+        _settings['save']['workers'] = None
+
+        _settings['history'] = {}
+        _settings['history']['budget'] = 256 * 1024 * 1024
+        _settings['history']['compress'] = True
 
     def _setup_icons(self):
         factory = Gtk.IconFactory()
@@ -215,10 +260,18 @@ class Application(Gtk.Application):
 
         win_actions = (
             ("new", self._new_cb),
+            ("save", self._save_cb),
+            ("undo", self._undo_cb),
+            ("redo", self._redo_cb),
             ("cut", self._cut_cb),
             ("copy", self._copy_cb),
             ("paste", self._paste_cb),
             ("remove_clear", self._remove_clear_cb),
+            ("insert_frame", self._insert_frame_cb),
+            ("delete_frame", self._delete_frame_cb),
+            ("set_loop_in", self._set_loop_in_cb),
+            ("set_loop_out", self._set_loop_out_cb),
+            ("clear_loop", self._clear_loop_cb),
             ("next_frame", self._next_frame_cb),
             ("previous_frame", self._previous_frame_cb),
             ("next_layer", self._next_layer_cb),
@@ -247,6 +300,11 @@ class Application(Gtk.Application):
             ("o", "win.onionskin", None),
             ("e", "win.eraser", None),
             ("BackSpace", "win.remove_clear", None),
+            ("Insert", "win.insert_frame", None),
+            ("Delete", "win.delete_frame", None),
+            ("bracketleft", "win.set_loop_in", None),
+            ("bracketright", "win.set_loop_out", None),
+            ("backslash", "win.clear_loop", None),
             ("<Control>Up", "win.previous_frame", None),
             ("<Control>Down", "win.next_frame", None),
             ("<Control>Left", "win.previous_layer", None),
@@ -0,0 +1,95 @@
+import mmap
+import struct
+import zipfile
+
+# Offsets of the name and extra field lengths in a zip local file
+# header.
+_LOCAL_HEADER_SIZE = 30
+_LOCAL_HEADER_LENGTHS = struct.Struct('<2H')
+_LOCAL_HEADER_LENGTHS_OFFSET = 26
+
+
+class Archive(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self._entries = {}
+
+        with open(filename, 'rb') as archive_file:
+            self._map = mmap.mmap(archive_file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+            xsheet_zip = zipfile.ZipFile(archive_file)
+            for info in xsheet_zip.infolist():
+                if info.compress_type == zipfile.ZIP_STORED:
+                    self._entries[info.filename] = self._get_data_range(info)
+                else:
+                    self._entries[info.filename] = xsheet_zip.read(info)
+            xsheet_zip.close()
+
+        self._view = memoryview(self._map)
+
+    def _get_data_range(self, info):
+        lengths_offset = info.header_offset + _LOCAL_HEADER_LENGTHS_OFFSET
+        name_length, extra_length = _LOCAL_HEADER_LENGTHS.unpack_from(
+            self._map, lengths_offset)
+        start = (info.header_offset + _LOCAL_HEADER_SIZE +
+                 name_length + extra_length)
+        return start, start + info.file_size
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def read(self, name):
+        entry = self._entries[name]
+        if isinstance(entry, tuple):
+            start, end = entry
+            return self._view[start:end]
+        return memoryview(entry)
+
+
+__test__ = dict(allem="""
+
+Archive gives access to the entries of a zip file without copying
+them.  Entries stored without compression are returned as memoryview
+slices of the memory mapped file.
+
+>>> import os
+>>> import tempfile
+>>> tempdir = tempfile.mkdtemp()
+>>> path = os.path.join(tempdir, 'test.zip')
+>>> test_zip = zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_STORED)
+>>> test_zip.writestr('cels/000-000001.png', b'some pixels')
+>>> test_zip.writestr('info.json', b'[]')
+>>> test_zip.close()
+
+>>> archive = Archive(path)
+>>> 'info.json' in archive
+True
+
+>>> data = archive.read('cels/000-000001.png')
+>>> isinstance(data, memoryview)
+True
+
+>>> bytes(data)
+b'some pixels'
+
+>>> bytes(archive.read('info.json'))
+b'[]'
+
+Compressed entries are read once when the archive is opened:
+
+>>> test_zip = zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED)
+>>> test_zip.writestr('info.json', b'[' + b' ' * 100 + b']')
+>>> test_zip.close()
+
+>>> len(Archive(path).read('info.json'))
+102
+
+>>> os.remove(path)
+>>> os.rmdir(tempdir)
+
+""")
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -1,5 +1,6 @@
 from gi.repository import Gegl
 from settings import get_settings
+from framecache import FrameCache
 
 _settings = get_settings()
 
@@ -24,6 +25,8 @@ class CanvasGraph(object):
 
         self._graph = None
         self._nodes = {}
+        self._frame_cache = FrameCache(xsheet, _settings['play']['cache'])
+        self._wired = {}
         self._create_graph()
 
     @property
@@ -40,6 +43,11 @@ class CanvasGraph(object):
         root_node = self._graph.create_child("gegl:nop")
         self._nodes['root_node'] = root_node
 
+        # While playing, flattened frames from the cache are presented
+        # through this node instead of the layers.
+        playback_node = self._graph.create_child("gegl:buffer-source")
+        self._nodes['playback_node'] = playback_node
+
         layer_overs = []
         for l in range(self._xsheet.layers_length):
             over = self._graph.create_child("gegl:over")
@@ -47,7 +55,7 @@ class CanvasGraph(object):
 
         self._nodes['layer_overs'] = layer_overs
 
-        layer_overs[0].connect_to("output", root_node, "input")
+        self._wire(layer_overs[0], root_node, "input")
 
         for over, next_over in zip(layer_overs, layer_overs[1:]):
             next_over.connect_to("output", over, "input")
@@ -76,8 +84,7 @@ class CanvasGraph(object):
                                               onionskin_opacities[1:]):
                     next_opacity.connect_to("output", over, "aux")
 
-                onionskin_opacities[0].connect_to("output", current_cel_over,
-                                                  "aux")
+                self._wire(onionskin_opacities[0], current_cel_over, "aux")
 
             nodes['onionskin'] = {}
             nodes['onionskin']['overs'] = onionskin_overs
@@ -88,7 +95,45 @@ class CanvasGraph(object):
 
         self._update_graph()
 
+    def _wire(self, source_node, node, pad):
+        # Reconnecting a pad invalidates the GEGL caches after it, so
+        # pads whose source doesn't change are left alone.
+        key = (node, pad)
+        if key in self._wired and self._wired[key] is source_node:
+            return False
+
+        if source_node is None:
+            node.disconnect(pad)
+        else:
+            source_node.connect_to("output", node, pad)
+        self._wired[key] = source_node
+        return True
+
+    def _present_cached_frame(self):
+        # The flattened frames are only worth their memory while
+        # playing.
+        if not self._xsheet.is_playing:
+            self._frame_cache.clear()
+            return False
+
+        self._frame_cache.start_filling()
+        frame_buffer = self._frame_cache.get(self._xsheet.current_frame)
+        if frame_buffer is None:
+            return False
+
+        self._nodes['playback_node'].set_property("buffer", frame_buffer)
+        self._wire(self._nodes['playback_node'], self._nodes['root_node'],
+                   "input")
+        return True
+
     def _update_graph(self):
+        if self._present_cached_frame():
+            return
+
+        if self._wire(self._nodes['layer_overs'][0],
+                      self._nodes['root_node'], "input"):
+            self._nodes['playback_node'].set_property("buffer", None)
+
         get_cel = None
         if _settings['onionskin']['by_cels']:
             get_cel = self._xsheet.get_cel_relative_by_cels
@@ -99,11 +144,10 @@ class CanvasGraph(object):
             layer_nodes = self._nodes['layer_nodes'][layer_idx]
             cur_cel = self._xsheet.get_cel(layer_idx=layer_idx)
 
+            cur_node = None
             if cur_cel is not None:
-                cur_cel.surface_node.connect_to(
-                    "output", layer_nodes['current_cel_over'], "input")
-            else:
-                layer_nodes['current_cel_over'].disconnect("input")
+                cur_node = cur_cel.surface_node
+            self._wire(cur_node, layer_nodes['current_cel_over'], "input")
 
             if self._xsheet.is_playing or not _settings['onionskin']['on']:
                 continue
@@ -113,10 +157,10 @@ class CanvasGraph(object):
                 prev_cel = get_cel(-(i+1), layer_diff=layer_diff)
                 over = layer_nodes['onionskin']['overs'][i]
 
+                prev_node = None
                 if prev_cel is not None:
-                    prev_cel.surface_node.connect_to("output", over, "input")
-                else:
-                    over.disconnect("input")
+                    prev_node = prev_cel.surface_node
+                self._wire(prev_node, over, "input")
 
         # debug
         # print_connections(self._nodes['root_node'])
@@ -129,10 +173,9 @@ class CanvasGraph(object):
             onionskin_opacities = layer_nodes['onionskin']['opacities']
             current_cel_over = layer_nodes['current_cel_over']
             if _settings['onionskin']['on']:
-                onionskin_opacities[0].connect_to("output", current_cel_over,
-                                                  "aux")
+                self._wire(onionskin_opacities[0], current_cel_over, "aux")
             else:
-                current_cel_over.disconnect("aux")
+                self._wire(None, current_cel_over, "aux")
 
         self._update_graph()
 
@@ -6,6 +6,7 @@ from gi.repository import Gdk
 from gi.repository import GeglGtk3 as GeglGtk
 
 from settings import get_settings
+from journal import get_brush_values
 
 _settings = get_settings()
 
@@ -92,14 +93,15 @@ class CanvasWidget(Gtk.EventBox):
         self.props.expand = True
 
         self._xsheet = xsheet
-        self._xsheet.connect('cursor-changed', self._xsheet_changed_cb)
 
         self._drawing = False
         self._panning = False
         self._last_event = None
         self._last_view_event = (0.0, 0.0, 0.0)  # (x, y, time)
 
-        self._surface = None
+        self._stroke_cel = None
+        self._stroke_buffer = None
+        self._stroke_tiles = set()
 
         self._view = CanvasView(xsheet)
         self._view.set_node(root_node)
@@ -129,13 +131,6 @@ class CanvasWidget(Gtk.EventBox):
     def zoom_view(self, direction):
         self._view.props.scale += _ZOOM_STEP * direction
 
-    def _xsheet_changed_cb(self, xsheet):
-        cel = self._xsheet.get_cel()
-        if cel is not None:
-            self._surface = cel.surface
-        else:
-            self._surface = None
-
     def _motion_to_cb(self, widget, event):
         (x, y, time) = event.x, event.y, event.time
 
@@ -145,7 +140,7 @@ class CanvasWidget(Gtk.EventBox):
                   self._view.props.scale)
 
         if self._drawing:
-            if self._surface is None:
+            if self._stroke_cel is None:
                 return
 
             pressure = event.get_axis(Gdk.AxisUse.PRESSURE)
@@ -160,11 +155,13 @@ class CanvasWidget(Gtk.EventBox):
 
             dtime = (time - self._last_view_event[2])/1000.0
 
-            self._surface.begin_atomic()
-            brush = _settings['brush']
-            brush.stroke_to(self._surface, view_x, view_y,
-                            pressure, xtilt, ytilt, dtime)
-            self._surface.end_atomic()
+            self._stroke_tiles.update(self._stroke_cel.stroke_to(
+                _settings['brush'], view_x, view_y, pressure, xtilt, ytilt,
+                dtime))
+
+            if self._xsheet.journal is not None:
+                self._xsheet.journal.record_sample(view_x, view_y, pressure,
+                                                   xtilt, ytilt, dtime)
 
         elif self._panning:
             if self._last_event is not None:
@@ -182,6 +179,21 @@ class CanvasWidget(Gtk.EventBox):
             if not self._xsheet.has_cel():
                 self._xsheet.add_cel()
 
+            # The cel is read from the xsheet, because the signals of a
+            # cursor change can still be waiting.  The stroke stays in
+            # this cel even if the cursor moves while drawing.  The
+            # tiles before the stroke are kept to undo it, the
+            # duplicated buffer shares them until the stroke draws.
+            self._stroke_cel = self._xsheet.get_cel()
+            if self._stroke_cel is not None:
+                self._stroke_buffer = self._stroke_cel.snapshot_buffer()
+                self._stroke_tiles = set()
+
+            if self._xsheet.journal is not None:
+                self._xsheet.journal.begin_stroke(
+                    self._xsheet.current_frame, self._xsheet.layer_idx,
+                    get_brush_values(_settings['brush']))
+
         elif event.button == 2:
             self._panning = True
 
@@ -190,6 +202,17 @@ class CanvasWidget(Gtk.EventBox):
             self._drawing = False
             _settings['brush'].reset()
 
+            if self._stroke_buffer is not None:
+                self._xsheet.push_stroke(self._stroke_cel,
+                                         self._stroke_buffer,
+                                         self._stroke_tiles)
+                self._stroke_buffer = None
+                self._stroke_tiles = set()
+            self._stroke_cel = None
+
+            if self._xsheet.journal is not None:
+                self._xsheet.journal.end_stroke()
+
         elif event.button == 2:
             self._panning = False
             self._last_event = None
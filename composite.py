@@ -0,0 +1,67 @@
+from gi.repository import Gegl
+
+from xsheet import PIXELS_FORMAT
+
+
+def create_over_chain(graph, source_nodes):
+    # As in the canvas, the first node goes on top.
+    top_node = source_nodes[-1]
+    for node in reversed(source_nodes[:-1]):
+        over = graph.create_child("gegl:over")
+        top_node.connect_to("output", over, "input")
+        node.connect_to("output", over, "aux")
+        top_node = over
+
+    return top_node
+
+
+def get_cels_extent(cels):
+    extents = [cel.extent_to_data() for cel in cels]
+    extents = [extent for extent in extents if extent[2] and extent[3]]
+    if not extents:
+        return [0, 0, 0, 0]
+
+    first_x = min(x for x, y, width, height in extents)
+    first_y = min(y for x, y, width, height in extents)
+    last_x = max(x + width for x, y, width, height in extents)
+    last_y = max(y + height for x, y, width, height in extents)
+    return [first_x, first_y, last_x - first_x, last_y - first_y]
+
+
+def render_cels(cels, rect=None, background=None):
+    # Without a rectangle, the result covers the extent of all the
+    # cels.  Without a background color, like "white", the areas with
+    # no drawing are transparent.
+    if rect is None:
+        rect = get_cels_extent(cels)
+
+    result = Gegl.Buffer.new(PIXELS_FORMAT, *rect)
+    if rect[2] == 0 or rect[3] == 0:
+        return result
+    if not cels and background is None:
+        return result
+
+    graph = Gegl.Node()
+    source_nodes = []
+    for cel in cels:
+        node = graph.create_child("gegl:buffer-source")
+        node.set_property("buffer", cel.gegl_surface.get_buffer())
+        source_nodes.append(node)
+
+    if background is not None:
+        # The color is infinite, so it is cropped to the result.
+        color = graph.create_child("gegl:color")
+        color.set_property("value", Gegl.Color.new(background))
+        crop = graph.create_child("gegl:crop")
+        for name, value in zip(["x", "y", "width", "height"], rect):
+            crop.set_property(name, float(value))
+        color.connect_to("output", crop, "input")
+        source_nodes.append(crop)
+
+    writer = graph.create_child("gegl:write-buffer")
+    writer.set_property("buffer", result)
+    create_over_chain(graph, source_nodes).connect_to("output", writer,
+                                                      "input")
+    writer.process()
+
+    return result
@@ -0,0 +1,118 @@
+import collections
+
+from gi.repository import GLib
+
+from composite import render_cels
+
+DEFAULT_BUDGET = 512 * 1024 * 1024
+DEFAULT_LOOKAHEAD = 48
+
+_PIXEL_SIZE = 4
+
+
+class FrameCache(object):
+    def __init__(self, xsheet, budget=DEFAULT_BUDGET,
+                 lookahead=DEFAULT_LOOKAHEAD):
+        self._xsheet = xsheet
+        self._budget = budget
+        self._lookahead = lookahead
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._fill_hid = None
+
+    @property
+    def size(self):
+        return self._size
+
+    def get_key(self, frame_idx):
+        # The frames that show the same cels, in the same revision,
+        # share the flattened image.  A cel that is drawn gets a new
+        # revision, so the images it was part of are not found again.
+        key = []
+        for layer_idx in range(self._xsheet.layers_length):
+            cel = self._xsheet.get_cel(frame_idx, layer_idx)
+            if cel is None:
+                key.append(None)
+            else:
+                key.append((cel, cel.revision))
+        return tuple(key)
+
+    def get(self, frame_idx):
+        key = self.get_key(frame_idx)
+        if key not in self._entries:
+            return None
+
+        self._entries.move_to_end(key)
+        return self._entries[key][0]
+
+    def render(self, frame_idx):
+        key = self.get_key(frame_idx)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+        frame_buffer = render_cels([cel for cel, revision in
+                                    filter(None, key)])
+        rect = frame_buffer.get_extent()
+        size = rect.width * rect.height * _PIXEL_SIZE
+        self._entries[key] = (frame_buffer, size)
+        self._size += size
+        self._evict()
+
+        return frame_buffer
+
+    def _evict(self):
+        while self._size > self._budget and len(self._entries) > 1:
+            key, (frame_buffer, size) = self._entries.popitem(last=False)
+            self._size -= size
+
+    def discard_stale(self):
+        for key in list(self._entries.keys()):
+            stale = any(entry is not None and entry[0].revision != entry[1]
+                        for entry in key)
+            if stale:
+                frame_buffer, size = self._entries.pop(key)
+                self._size -= size
+
+    def clear(self):
+        self.stop_filling()
+        self._entries.clear()
+        self._size = 0
+
+    def start_filling(self):
+        if self._fill_hid is None:
+            self.discard_stale()
+            self._fill_hid = GLib.idle_add(self._fill_cb)
+
+    def stop_filling(self):
+        if self._fill_hid is None:
+            return
+
+        GLib.source_remove(self._fill_hid)
+        self._fill_hid = None
+
+    def _fill_cb(self):
+        # One frame is rendered on each idle iteration, so presenting
+        # the frames in time comes first.  The upcoming frames are kept
+        # as the most recently used.  If they fill the budget already,
+        # rendering more would only evict the next ones.
+        if self._xsheet.is_playing:
+            upcoming = self._xsheet.playback.get_upcoming_frames(
+                self._lookahead)
+            upcoming_keys = set()
+            for frame_idx in upcoming:
+                key = self.get_key(frame_idx)
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    upcoming_keys.add(key)
+                    continue
+
+                oldest_key = next(iter(self._entries), None)
+                if self._size >= self._budget and oldest_key in upcoming_keys:
+                    break
+
+                self.render(frame_idx)
+                return True
+
+        self._fill_hid = None
+        return False
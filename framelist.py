@@ -1,9 +1,14 @@
+import math
 import bisect
+from array import array
 
 
 class FrameList(object):
     def __init__(self):
-        self._values = {}
+        self._frames = array('l')
+        self._values = []
+        self._version = 0
+        self._cache = {}
 
     def __len__(self):
         return 0
@@ -12,46 +17,125 @@ class FrameList(object):
         return self.get_relative(frame)
 
     def __setitem__(self, frame, value):
-        self._values[frame] = value
+        idx = bisect.bisect_left(self._frames, frame)
+        if idx < len(self._frames) and self._frames[idx] == frame:
+            self._values[idx] = value
+        else:
+            self._frames.insert(idx, frame)
+            self._values.insert(idx, value)
+        self._changed()
 
     def __delitem__(self, frame):
-        self._values.pop(frame)
+        idx = self._get_index(frame)
+        if idx is None:
+            raise KeyError(frame)
+
+        del self._frames[idx]
+        del self._values[idx]
+        self._changed()
+
+    @property
+    def version(self):
+        return self._version
+
+    def _changed(self):
+        self._version += 1
+        self._cache.clear()
+
+    def _get_cached(self, name, compute):
+        if name not in self._cache:
+            self._cache[name] = compute()
+        return self._cache[name]
+
+    def _get_index(self, frame):
+        idx = bisect.bisect_left(self._frames, frame)
+        if idx < len(self._frames) and self._frames[idx] == frame:
+            return idx
+        return None
 
     def get_assigned_frames(self):
-        return sorted(self._values.keys())
+        return self._frames.tolist()
 
     def get_first_frame(self):
-        assigned = self.get_assigned_frames()
-        if not assigned:
+        if not self._frames:
             return None
 
-        return assigned[0]
+        return self._frames[0]
 
     def get_last_frame(self):
-        assigned = self.get_assigned_frames()
-        if not assigned:
+        if not self._frames:
             return None
 
-        return assigned[-1]
+        return self._frames[-1]
+
+    def get_content_runs(self):
+        return list(self._get_cached('content_runs',
+                                     self._compute_content_runs))
+
+    def _compute_content_runs(self):
+        next_frames = self._frames[1:].tolist() + [None]
+        return list(zip(self._frames, next_frames, self._values))
 
     def get_content_sublist(self):
-        changing_frames = self.get_assigned_frames()
         result = []
 
-        for frame, next_frame in zip(changing_frames, changing_frames[1:]):
-            result.extend([self._values[frame]] * (next_frame - frame))
-
-        result.append(self._values[changing_frames[-1]])
+        for frame, next_frame, value in self.get_content_runs():
+            if next_frame is None:
+                result.append(value)
+            else:
+                result.extend([value] * (next_frame - frame))
 
         return result
 
-    def get_extremes(self):
-        changing_frames = self.get_assigned_frames()
+    def iter_content(self, first=None, last=None):
+        if first is None:
+            first = self.get_first_frame()
+            if first is None:
+                return
+
+        idx = bisect.bisect_left(self._frames, first)
+        frame = first
+
+        while last is None or frame < last:
+            if idx < len(self._frames) and self._frames[idx] == frame:
+                value = self._values[idx]
+                idx += 1
+                if value is not None:
+                    yield frame, value, "cel"
+                else:
+                    yield frame, value, "clear"
+            elif idx > 0 and self._values[idx - 1] is not None:
+                yield frame, self._values[idx - 1], "repeat cel"
+            else:
+                yield frame, None, "repeat clear"
+            frame += 1
+
+    def get_extremes(self, first=None, last=None):
+        extremes = self._get_cached('extremes', self._compute_extremes)
+        if first is None and last is None:
+            return list(extremes)
+
+        lower = 0
+        upper = len(extremes)
+        if first is not None:
+            ends = self._get_cached(
+                'extremes_ends',
+                lambda: [float('inf') if end is None else end
+                         for start, end in extremes])
+            lower = bisect.bisect(ends, first)
+        if last is not None:
+            starts = self._get_cached(
+                'extremes_starts',
+                lambda: [start for start, end in extremes])
+            upper = bisect.bisect_left(starts, last)
+
+        return extremes[lower:upper]
+
+    def _compute_extremes(self):
         result = []
         start = None
 
-        for frame in changing_frames:
-            value = self._values[frame]
+        for frame, value in zip(self._frames, self._values):
             if start is None:
                 if value is not None:
                     start = frame
@@ -66,9 +150,13 @@ class FrameList(object):
         return result
 
     def get_type_at(self, frame, separate_repeats=True):
-        value = self[frame]
-        assigned_frames = self._values.keys()
-        if frame not in assigned_frames:
+        idx = bisect.bisect(self._frames, frame)
+        if idx == 0:
+            value = None
+        else:
+            value = self._values[idx - 1]
+
+        if idx == 0 or self._frames[idx - 1] != frame:
             if not separate_repeats:
                 return "repeat"
             else:
@@ -82,6 +170,35 @@ class FrameList(object):
             else:
                 return "clear"
 
+    def get_type_runs(self, first, last):
+        changing_frames = self._frames
+        idx = bisect.bisect_left(changing_frames, first)
+        result = []
+        frame = first
+
+        while frame < last:
+            if idx < len(changing_frames) and changing_frames[idx] == frame:
+                if self._values[idx] is not None:
+                    result.append((frame, frame + 1, "cel"))
+                else:
+                    result.append((frame, frame + 1, "clear"))
+                frame += 1
+                idx += 1
+                continue
+
+            if idx < len(changing_frames):
+                next_frame = min(changing_frames[idx], last)
+            else:
+                next_frame = last
+
+            if idx > 0 and self._values[idx - 1] is not None:
+                result.append((frame, next_frame, "repeat cel"))
+            else:
+                result.append((frame, next_frame, "repeat clear"))
+            frame = next_frame
+
+        return result
+
     def has_cel_at(self, frame):
         return self.get_type_at(frame) == 'cel'
 
@@ -98,19 +215,85 @@ class FrameList(object):
         return self.get_type_at(frame) == 'repeat clear'
 
     def get_relative(self, frame, steps=0):
-        changing_frames = self.get_assigned_frames()
+        changing_frames = self._frames
         idx = bisect.bisect(changing_frames, frame)
         if idx == 0:
             return None
         if steps == 0:
-            return self._values[changing_frames[idx - 1]]
+            return self._values[idx - 1]
         if idx - 1 + steps < 0:
             return None
         try:
-            return self._values[changing_frames[idx - 1 + steps]]
+            return self._values[idx - 1 + steps]
         except IndexError:
             return None
 
+    def insert_frames(self, frame, length=1):
+        idx = bisect.bisect_left(self._frames, frame)
+        self._shift_from(idx, length)
+        self._changed()
+
+    def delete_frames(self, frame, length=1):
+        lower = bisect.bisect_left(self._frames, frame)
+        upper = bisect.bisect_left(self._frames, frame + length)
+        removed = list(zip(self._frames[lower:upper],
+                           self._values[lower:upper]))
+        held = removed and self._get_index(frame + length) is None
+
+        del self._frames[lower:upper]
+        del self._values[lower:upper]
+        self._shift_from(lower, -length)
+
+        # A cel held past the deleted frames keeps showing after them.
+        if held:
+            self._frames.insert(lower, frame)
+            self._values.insert(lower, removed[-1][1])
+        self._changed()
+
+        return removed
+
+    def scale_timing(self, factor, first=0):
+        assert factor > 0
+        idx = bisect.bisect_left(self._frames, first)
+        new_frames = array('l')
+        new_values = []
+
+        for frame, value in zip(self._frames[idx:], self._values[idx:]):
+            new_frame = first + int(math.floor((frame - first) * factor))
+            # When two cels fall in the same frame, the first one stays.
+            if new_frames and new_frames[-1] == new_frame:
+                continue
+            new_frames.append(new_frame)
+            new_values.append(value)
+
+        self._frames[idx:] = new_frames
+        self._values[idx:] = new_values
+        self._changed()
+
+    def get_entries(self, first, last=None):
+        lower = bisect.bisect_left(self._frames, first)
+        if last is None:
+            upper = len(self._frames)
+        else:
+            upper = bisect.bisect_left(self._frames, last)
+        return list(zip(self._frames[lower:upper], self._values[lower:upper]))
+
+    def set_entries(self, first, last, entries):
+        lower = bisect.bisect_left(self._frames, first)
+        if last is None:
+            upper = len(self._frames)
+        else:
+            upper = bisect.bisect_left(self._frames, last)
+        self._frames[lower:upper] = array('l', [frame for frame, value
+                                                in entries])
+        self._values[lower:upper] = [value for frame, value in entries]
+        self._changed()
+
+    def _shift_from(self, idx, offset):
+        if idx < len(self._frames):
+            self._frames[idx:] = array(
+                'l', [frame + offset for frame in self._frames[idx:]])
+
     def remove_clear(self, frame):
         if self.has_cel_at(frame) or self.has_clear_at(frame):
             del self[frame]
@@ -144,6 +327,12 @@ True
 >>> frames.get_last_frame() is None
 True
 
+>>> frames.get_content_sublist()
+[]
+
+>>> list(frames.iter_content())
+[]
+
 Indexs in FrameList are frame numbers.  When a cel is assigned to one
 frame, the cel is repeated until another cel or None is assigned.
 
@@ -202,6 +391,33 @@ You can, however, iterate the sublist where frames have content:
 >>> frames.get_content_sublist()
 ['b', 'b', 'b', None]
 
+Or, without expanding the repeated frames, the runs of content as
+(start, end, value) tuples.  The last run has no end:
+
+>>> frames.get_content_runs()
+[(3, 6, 'b'), (6, None, None)]
+
+To walk the frames one by one without building a list, use
+iter_content.  It yields (frame, value, type) tuples lazily, from the
+first assigned frame or from any other frame, until the last frame
+given (not included):
+
+>>> for frame, value, frame_type in frames.iter_content(2, 8):
+...     print(frame, value, frame_type)
+2 None repeat clear
+3 b cel
+4 b repeat cel
+5 b repeat cel
+6 None clear
+7 None repeat clear
+
+If no last frame is given, it goes on forever, so stop when you are
+done:
+
+>>> import itertools
+>>> list(itertools.islice(frames.iter_content(), 4))
+[(3, 'b', 'cel'), (4, 'b', 'repeat cel'), (5, 'b', 'repeat cel'), (6, None, 'clear')]
+
 Note that when we set None to a frame to clear, it belongs to the
 assigned frames, unlike other frames with None.
 
@@ -277,6 +493,19 @@ the same like this:
 >>> frames.get_type_at(7)
 'repeat clear'
 
+To ask the types of a whole range of frames at once, use
+get_type_runs.  It returns a list of (start, end, type) runs, where
+end is not included:
+
+>>> frames.get_type_runs(0, 10)
+[(0, 3, 'repeat clear'), (3, 4, 'cel'), (4, 6, 'repeat cel'), (6, 7, 'clear'), (7, 10, 'repeat clear')]
+
+>>> frames.get_type_runs(4, 5)
+[(4, 5, 'repeat cel')]
+
+>>> frames.get_type_runs(5, 5)
+[]
+
 Let's add one more cel.
 
 >>> frames[1] = 'a'
@@ -396,6 +625,114 @@ Another example with two subsets:
 >>> frames.get_extremes()
 [(2, 6), (8, 10)]
 
+The extremes can be asked for a range of frames, from the first frame
+to the last frame (not included).  Only the extremes that overlap the
+range are returned:
+
+>>> frames.get_extremes(7, 20)
+[(8, 10)]
+
+>>> frames.get_extremes(0, 3)
+[(2, 6)]
+
+>>> frames.get_extremes(6, 8)
+[]
+
+>>> frames.get_extremes(5, 9)
+[(2, 6), (8, 10)]
+
+Summaries like the extremes are computed once and reused until the
+FrameList changes.  Each change increments its version:
+
+>>> version = frames.version
+>>> frames[14] = "w"
+>>> frames.version == version + 1
+True
+
+>>> frames.get_extremes(11, None)
+[(14, None)]
+
+Retiming a sequence doesn't require to move the cels one by one.  To
+insert blank frames, holding the previous value, use insert_frames:
+
+>>> frames = FrameList()
+>>> frames[0] = 'a'
+>>> frames[2] = 'b'
+>>> frames[4] = 'c'
+>>> frames.insert_frames(2, length=3)
+>>> frames.get_content_sublist()
+['a', 'a', 'a', 'a', 'a', 'b', 'b', 'c']
+
+delete_frames removes a range of frames and moves the following ones
+back.  It returns the (frame, value) pairs that were removed:
+
+>>> frames.delete_frames(1, length=4)
+[]
+
+>>> frames.get_content_sublist()
+['a', 'b', 'b', 'c']
+
+>>> frames.delete_frames(1, length=2)
+[(1, 'b')]
+
+>>> frames.get_content_sublist()
+['a', 'c']
+
+A cel held past the deleted frames keeps showing after them:
+
+>>> frames = FrameList()
+>>> frames[0] = 'a'
+>>> frames[2] = 'b'
+>>> frames[10] = 'c'
+>>> frames.delete_frames(2, length=3)
+[(2, 'b')]
+
+>>> frames.get_content_sublist()
+['a', 'a', 'b', 'b', 'b', 'b', 'b', 'c']
+
+And scale_timing changes the speed from a frame on.  For example, to
+go from animating on twos to animating on ones:
+
+>>> frames = FrameList()
+>>> frames[0] = 'a'
+>>> frames[2] = 'b'
+>>> frames[4] = 'c'
+>>> frames[6] = None
+>>> frames.scale_timing(0.5)
+>>> frames.get_content_sublist()
+['a', 'b', 'c', None]
+
+>>> frames.scale_timing(2, first=1)
+>>> frames.get_content_sublist()
+['a', 'b', 'b', 'c', 'c', None]
+
+Going faster than ones leaves no room for every cel.  When two cels
+fall in the same frame, the first one stays:
+
+>>> ones = FrameList()
+>>> ones[0] = 'a'
+>>> ones[1] = 'b'
+>>> ones[2] = 'c'
+>>> ones.scale_timing(0.5)
+>>> ones.get_content_sublist()
+['a', 'c']
+
+The (frame, value) pairs assigned in a range of frames can be taken
+and put back, which is cheap for undoing an edit.  With no last frame,
+the range goes until the end:
+
+>>> entries = frames.get_entries(1)
+>>> entries
+[(1, 'b'), (3, 'c'), (5, None)]
+
+>>> frames.remove_clear(3)
+>>> frames.get_entries(1, 4)
+[(1, 'b')]
+
+>>> frames.set_entries(1, None, entries)
+>>> frames.get_content_sublist()
+['a', 'b', 'b', 'c', 'c', None]
+
 """)
 
 
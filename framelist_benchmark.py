@@ -0,0 +1,323 @@
+import sys
+import math
+import timeit
+import random
+import bisect
+import argparse
+
+from framelist import FrameList
+
+_SIZES = [10 ** 2, 10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6]
+_QUERIES = 1000
+_SCAN_WINDOW = 2000
+
+
+class ReferenceFrameList(object):
+    def __init__(self):
+        self._values = {}
+
+    def __getitem__(self, frame):
+        return self.get_relative(frame)
+
+    def __setitem__(self, frame, value):
+        self._values[frame] = value
+
+    def __delitem__(self, frame):
+        self._values.pop(frame)
+
+    def get_assigned_frames(self):
+        return sorted(self._values.keys())
+
+    def get_first_frame(self):
+        assigned = self.get_assigned_frames()
+        if not assigned:
+            return None
+
+        return assigned[0]
+
+    def get_last_frame(self):
+        assigned = self.get_assigned_frames()
+        if not assigned:
+            return None
+
+        return assigned[-1]
+
+    def get_content_sublist(self):
+        changing_frames = self.get_assigned_frames()
+        if not changing_frames:
+            return []
+
+        result = []
+        for frame, next_frame in zip(changing_frames, changing_frames[1:]):
+            result.extend([self._values[frame]] * (next_frame - frame))
+
+        result.append(self._values[changing_frames[-1]])
+
+        return result
+
+    def get_extremes(self):
+        result = []
+        start = None
+
+        for frame in self.get_assigned_frames():
+            value = self._values[frame]
+            if start is None:
+                if value is not None:
+                    start = frame
+            else:
+                if value is None:
+                    result.append((start, frame))
+                    start = None
+
+        if start is not None:
+            result.append((start, None))
+
+        return result
+
+    def get_type_at(self, frame, separate_repeats=True):
+        value = self[frame]
+        if frame not in self._values:
+            if not separate_repeats:
+                return "repeat"
+            else:
+                if value is not None:
+                    return "repeat cel"
+                else:
+                    return "repeat clear"
+        else:
+            if value is not None:
+                return "cel"
+            else:
+                return "clear"
+
+    def get_relative(self, frame, steps=0):
+        changing_frames = self.get_assigned_frames()
+        idx = bisect.bisect(changing_frames, frame)
+        if idx == 0:
+            return None
+        if steps == 0:
+            return self._values[changing_frames[idx - 1]]
+        if idx - 1 + steps < 0:
+            return None
+        try:
+            return self._values[changing_frames[idx - 1 + steps]]
+        except IndexError:
+            return None
+
+    def insert_frames(self, frame, length=1):
+        self._values = dict(
+            (key + length if key >= frame else key, value)
+            for key, value in self._values.items())
+
+    def delete_frames(self, frame, length=1):
+        removed = [(key, self._values[key])
+                   for key in self.get_assigned_frames()
+                   if frame <= key < frame + length]
+        self._values = dict(
+            (key - length if key >= frame + length else key, value)
+            for key, value in self._values.items()
+            if not frame <= key < frame + length)
+        if removed and frame not in self._values:
+            self._values[frame] = removed[-1][1]
+        return removed
+
+    def scale_timing(self, factor, first=0):
+        values = {}
+        for key in self.get_assigned_frames():
+            new_key = key
+            if key >= first:
+                new_key = first + int(math.floor((key - first) * factor))
+            if new_key not in values:
+                values[new_key] = self._values[key]
+        self._values = values
+
+    def remove_clear(self, frame):
+        if self.get_type_at(frame) in ('cel', 'clear'):
+            del self[frame]
+        else:
+            self[frame] = None
+
+
+def _compare(frames, reference, rng, span):
+    def check(name, *args):
+        expected = getattr(reference, name)(*args)
+        got = getattr(frames, name)(*args)
+        assert got == expected, (name, args, got, expected)
+
+    check('get_assigned_frames')
+    check('get_first_frame')
+    check('get_last_frame')
+    check('get_content_sublist')
+    check('get_extremes')
+
+    for i in range(20):
+        frame = rng.randint(-2, span + 2)
+        check('__getitem__', frame)
+        check('get_type_at', frame)
+        check('get_type_at', frame, False)
+        check('get_relative', frame, rng.randint(-4, 4))
+
+    first = rng.randint(-2, span)
+    last = first + rng.randint(0, span)
+    runs = frames.get_type_runs(first, last)
+    expanded = [frame_type for start, end, frame_type in runs
+                for frame in range(start, end)]
+    expected = [reference.get_type_at(frame)
+                for frame in range(first, last)]
+    assert expanded == expected, ('get_type_runs', first, last)
+
+    content = [(frame, value, frame_type) for frame, value, frame_type
+               in frames.iter_content(first, last)]
+    expected = [(frame, reference[frame], reference.get_type_at(frame))
+                for frame in range(first, last)]
+    assert content == expected, ('iter_content', first, last)
+
+    extremes = reference.get_extremes()
+    expected = [(start, end) for start, end in extremes
+                if start < last and (end is None or end > first)]
+    got = frames.get_extremes(first, last)
+    assert got == expected, ('get_extremes', first, last, got, expected)
+
+
+def check_against_reference(seed, operations=200, span=60):
+    rng = random.Random(seed)
+    frames = FrameList()
+    reference = ReferenceFrameList()
+
+    for i in range(operations):
+        operation = rng.choice(['set', 'set', 'set', 'clear', 'del',
+                                'remove_clear', 'insert', 'delete',
+                                'scale'])
+        frame = rng.randint(0, span)
+
+        if operation == 'set':
+            value = rng.randint(0, 9)
+            frames[frame] = value
+            reference[frame] = value
+        elif operation == 'clear':
+            frames[frame] = None
+            reference[frame] = None
+        elif operation == 'del':
+            if frame in reference.get_assigned_frames():
+                del frames[frame]
+                del reference[frame]
+        elif operation == 'remove_clear':
+            frames.remove_clear(frame)
+            reference.remove_clear(frame)
+        elif operation == 'insert':
+            length = rng.randint(1, 4)
+            frames.insert_frames(frame, length)
+            reference.insert_frames(frame, length)
+        elif operation == 'delete':
+            length = rng.randint(1, 4)
+            removed = frames.delete_frames(frame, length)
+            assert removed == reference.delete_frames(frame, length)
+        elif operation == 'scale':
+            factor = rng.choice([0.5, 1.5, 2])
+            frames.scale_timing(factor, frame)
+            reference.scale_timing(factor, frame)
+
+        _compare(frames, reference, rng, span)
+
+
+def _build(frame_list_class, size, rng):
+    frames = frame_list_class()
+    frame = 0
+    for i in range(size):
+        frame += rng.choice([1, 2, 2, 3, 4])
+        if rng.random() < 0.1:
+            frames[frame] = None
+        else:
+            frames[frame] = i
+
+    return frames, frame
+
+
+def _time(statement, number):
+    timer = timeit.Timer(statement)
+    return min(timer.repeat(repeat=3, number=number)) / number
+
+
+def run_benchmarks(sizes, frame_list_class=FrameList, out=sys.stdout):
+    out.write("{0:>8} {1:>12} {2:>12} {3:>12} {4:>12} {5:>12}\n".format(
+        "size", "getitem", "relative", "type_at", "extremes", "scan"))
+
+    for size in sizes:
+        rng = random.Random(size)
+        frames, last_frame = _build(frame_list_class, size, rng)
+        queries = [rng.randint(0, last_frame) for i in range(_QUERIES)]
+
+        def getitem():
+            for frame in queries:
+                frames[frame]
+
+        def relative():
+            for frame in queries:
+                frames.get_relative(frame, -2)
+
+        def type_at():
+            for frame in queries:
+                frames.get_type_at(frame)
+
+        def extremes():
+            frames.get_extremes()
+
+        first = last_frame // 2
+        last = first + _SCAN_WINDOW
+        if hasattr(frames, 'get_type_runs'):
+            def scan():
+                frames.get_type_runs(first, last)
+        else:
+            def scan():
+                for frame in range(first, last):
+                    frames.get_type_at(frame)
+
+        number = max(1, 10 ** 5 // max(size, _QUERIES))
+        results = [_time(getitem, number) / _QUERIES,
+                   _time(relative, number) / _QUERIES,
+                   _time(type_at, number) / _QUERIES,
+                   _time(extremes, number),
+                   _time(scan, number)]
+
+        out.write("{0:>8} ".format(size) +
+                  " ".join("{0:>10.2f}us".format(seconds * 10 ** 6)
+                           for seconds in results) + "\n")
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Benchmark and check the FrameList implementation.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=_SIZES,
+                        help="number of exposures of each benchmark")
+    parser.add_argument('--reference', action='store_true',
+                        help="benchmark the reference implementation")
+    parser.add_argument('--check', type=int, default=0, metavar='N',
+                        help="run N randomized checks against the "
+                        "reference implementation before benchmarking")
+    args = parser.parse_args(argv)
+
+    for seed in range(args.check):
+        check_against_reference(seed)
+    if args.check:
+        print("{0} randomized checks passed".format(args.check))
+
+    if args.reference:
+        run_benchmarks(args.sizes, ReferenceFrameList)
+    else:
+        run_benchmarks(args.sizes)
+
+
+__test__ = dict(allem="""
+
+The optimized FrameList must behave exactly as the reference
+implementation.  Random sequences of edits are applied to both, and
+every query is compared after each edit:
+
+>>> for seed in range(10):
+...     check_against_reference(seed)
+
+""")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,255 @@
+import zlib
+import collections
+
+DEFAULT_BUDGET = 256 * 1024 * 1024
+
+# The most recent edits are kept uncompressed, so undoing them is
+# immediate.
+_RECENT_EDITS = 8
+
+
+class StrokeEdit(object):
+    def __init__(self, cel, regions_before, regions_after):
+        self._cel = cel
+        self._regions_before = regions_before
+        self._regions_after = regions_after
+        self._compressed = False
+
+    @property
+    def cel(self):
+        return self._cel
+
+    @property
+    def regions_before(self):
+        return self._get_regions(self._regions_before)
+
+    @property
+    def regions_after(self):
+        return self._get_regions(self._regions_after)
+
+    @property
+    def size(self):
+        return sum(len(region[4]) for region in
+                   self._regions_before + self._regions_after)
+
+    def _get_regions(self, regions):
+        if not self._compressed:
+            return regions
+        return [region[:4] + (zlib.decompress(region[4]),)
+                for region in regions]
+
+    def compress(self):
+        if self._compressed:
+            return
+
+        self._regions_before = [region[:4] + (zlib.compress(region[4]),)
+                                for region in self._regions_before]
+        self._regions_after = [region[:4] + (zlib.compress(region[4]),)
+                               for region in self._regions_after]
+        self._compressed = True
+
+    def undo(self):
+        self._cel.set_regions(self.regions_before)
+        self._cel.mark_dirty()
+
+    def redo(self):
+        self._cel.set_regions(self.regions_after)
+        self._cel.mark_dirty()
+
+
+class CallbackEdit(object):
+    # The scope is what the edit changes, for the owner of the
+    # history to look at.
+    def __init__(self, undo_cb, redo_cb, size=0, scope=None):
+        self._undo_cb = undo_cb
+        self._redo_cb = redo_cb
+        self.size = size
+        self.scope = scope
+
+    def compress(self):
+        pass
+
+    def undo(self):
+        self._undo_cb()
+
+    def redo(self):
+        self._redo_cb()
+
+
+class History(object):
+    def __init__(self, budget=DEFAULT_BUDGET, compress=True):
+        self._budget = budget
+        self._compress = compress
+        self._undo_edits = collections.deque()
+        self._redo_edits = []
+        self._size = 0
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def can_undo(self):
+        return len(self._undo_edits) > 0
+
+    @property
+    def can_redo(self):
+        return len(self._redo_edits) > 0
+
+    @property
+    def undo_edit(self):
+        if not self._undo_edits:
+            return None
+        return self._undo_edits[-1]
+
+    @property
+    def redo_edit(self):
+        if not self._redo_edits:
+            return None
+        return self._redo_edits[-1]
+
+    def set_budget(self, budget, compress=None):
+        self._budget = budget
+        if compress is not None:
+            self._compress = compress
+        self._evict()
+
+    def clear(self):
+        self._undo_edits.clear()
+        self._redo_edits = []
+        self._size = 0
+
+    def push(self, edit):
+        for redo_edit in self._redo_edits:
+            self._size -= redo_edit.size
+        self._redo_edits = []
+
+        self._undo_edits.append(edit)
+        self._size += edit.size
+
+        if self._compress and len(self._undo_edits) > _RECENT_EDITS:
+            old_edit = self._undo_edits[-_RECENT_EDITS - 1]
+            self._size -= old_edit.size
+            old_edit.compress()
+            self._size += old_edit.size
+
+        self._evict()
+
+    def _evict(self):
+        # The oldest edits are forgotten first.  The last edit is kept
+        # even if it is bigger than the whole budget.
+        while self._size > self._budget and len(self._undo_edits) > 1:
+            self._size -= self._undo_edits.popleft().size
+
+    def undo(self):
+        if not self._undo_edits:
+            return False
+
+        edit = self._undo_edits.pop()
+        edit.undo()
+        self._redo_edits.append(edit)
+        return True
+
+    def redo(self):
+        if not self._redo_edits:
+            return False
+
+        edit = self._redo_edits.pop()
+        edit.redo()
+        self._undo_edits.append(edit)
+        return True
+
+
+__test__ = dict(allem="""
+
+History keeps the edits that can be undone and redone.
+
+>>> values = []
+>>> def append_edit(value):
+...     values.append(value)
+...     return CallbackEdit(values.pop, lambda: values.append(value),
+...                         size=10)
+
+>>> history = History(budget=35)
+>>> history.push(append_edit('a'))
+>>> history.push(append_edit('b'))
+>>> values
+['a', 'b']
+
+>>> history.undo()
+True
+
+>>> values
+['a']
+
+>>> history.redo()
+True
+
+>>> values
+['a', 'b']
+
+The edits that undo and redo would take are at hand:
+
+>>> history.undo_edit.size, history.redo_edit
+(10, None)
+
+A new edit discards the edits that were undone:
+
+>>> history.undo()
+True
+
+>>> history.push(append_edit('c'))
+>>> history.can_redo
+False
+
+>>> values
+['a', 'c']
+
+When the size of the edits goes over the budget, the oldest ones are
+forgotten:
+
+>>> history.push(append_edit('d'))
+>>> history.push(append_edit('e'))
+>>> history.size
+30
+
+>>> while history.undo():
+...     pass
+>>> values
+['a']
+
+Stroke edits restore the tiles of a cel that changed in a stroke.  Old
+edits are compressed:
+
+>>> class FakeCel(object):
+...     regions = None
+...     dirty = False
+...     def set_regions(self, regions):
+...         self.regions = regions
+...     def mark_dirty(self):
+...         self.dirty = True
+
+>>> cel = FakeCel()
+>>> before = [(0, 64, 64, 64, bytes(64 * 64 * 4))]
+>>> after = [(0, 64, 64, 64, b'1234' * 64 * 64)]
+>>> history = History()
+>>> history.push(StrokeEdit(cel, before, after))
+>>> history.size
+32768
+
+>>> for i in range(8):
+...     history.push(CallbackEdit(list, list))
+>>> history.size < 32768
+True
+
+>>> while history.undo():
+...     pass
+>>> cel.regions == before and cel.dirty
+True
+
+""")
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,386 @@
+import os
+import json
+import struct
+import traceback
+
+_MAGIC = b'XSJ2'
+
+# Each time the journal starts again it gets a new random generation,
+# after the magic.  A save stores the generation and the position it
+# covers, so records already saved are not replayed again.
+_GENERATION_SIZE = 8
+_HEADER_SIZE = len(_MAGIC) + _GENERATION_SIZE
+
+# Edits are recorded with their explicit frame and layer, so they can
+# be replayed no matter where the cursor is.
+_EDITS = {
+    'new': (1, struct.Struct('<i')),
+    'add_cel': (2, struct.Struct('<ii')),
+    'remove_clear': (3, struct.Struct('<ii')),
+    'cut': (4, struct.Struct('<ii')),
+    'copy': (5, struct.Struct('<ii')),
+    'paste': (6, struct.Struct('<ii')),
+    'insert_frames': (7, struct.Struct('<iii')),
+    'delete_frames': (8, struct.Struct('<iii')),
+    'scale_timing': (9, struct.Struct('<dii')),
+}
+
+# Undo and redo are recorded as the state they leave, so replaying them
+# doesn't need the edits from before the last save.  The state goes in
+# a JSON document of any length.
+_DATA_EDITS = {
+    'restore_entries': 12,
+    'restore_regions': 13,
+}
+
+_STROKE_BEGIN = 32
+_STROKE_SAMPLE = 33
+_STROKE_END = 34
+
+_BRUSH_SETTINGS = ['color_h', 'color_s', 'color_v', 'eraser',
+                   'radius_logarithmic']
+
+_STROKE_BEGIN_STRUCT = struct.Struct('<ii{0}f'.format(len(_BRUSH_SETTINGS)))
+_STROKE_SAMPLE_STRUCT = struct.Struct('<6f')
+_OPCODE_STRUCT = struct.Struct('<B')
+_DATA_LENGTH_STRUCT = struct.Struct('<I')
+
+_RECORD_STRUCTS = dict((opcode, (name, record_struct))
+                       for name, (opcode, record_struct) in _EDITS.items())
+_RECORD_STRUCTS[_STROKE_BEGIN] = ('stroke-begin', _STROKE_BEGIN_STRUCT)
+_RECORD_STRUCTS[_STROKE_SAMPLE] = ('stroke-sample', _STROKE_SAMPLE_STRUCT)
+_RECORD_STRUCTS[_STROKE_END] = ('stroke-end', None)
+
+_DATA_RECORDS = dict((opcode, name) for name, opcode in _DATA_EDITS.items())
+
+
+class Journal(object):
+    def __init__(self, path):
+        self._path = path
+        self._file = None
+        self._stroke_position = None
+
+    @property
+    def path(self):
+        return self._path
+
+    def _get_file(self):
+        if self._file is None:
+            is_new = (not os.path.exists(self._path) or
+                      os.path.getsize(self._path) == 0)
+            self._file = open(self._path, 'ab')
+            if is_new:
+                self._file.write(_MAGIC + os.urandom(_GENERATION_SIZE))
+        return self._file
+
+    @property
+    def generation(self):
+        if self._file is not None:
+            self._file.flush()
+        if not os.path.exists(self._path):
+            return None
+
+        with open(self._path, 'rb') as journal_file:
+            header = journal_file.read(_HEADER_SIZE)
+        if len(header) < _HEADER_SIZE or not header.startswith(_MAGIC):
+            return None
+        return header[len(_MAGIC):].hex()
+
+    def record_edit(self, name, *args):
+        opcode, record_struct = _EDITS[name]
+        journal_file = self._get_file()
+        journal_file.write(_OPCODE_STRUCT.pack(opcode))
+        journal_file.write(record_struct.pack(*args))
+        journal_file.flush()
+
+    def record_data(self, name, data):
+        encoded = json.dumps(data).encode('utf-8')
+        journal_file = self._get_file()
+        journal_file.write(_OPCODE_STRUCT.pack(_DATA_EDITS[name]))
+        journal_file.write(_DATA_LENGTH_STRUCT.pack(len(encoded)))
+        journal_file.write(encoded)
+        journal_file.flush()
+
+    def begin_stroke(self, frame_idx, layer_idx, brush_values):
+        journal_file = self._get_file()
+        self._stroke_position = journal_file.tell()
+        journal_file.write(_OPCODE_STRUCT.pack(_STROKE_BEGIN))
+        journal_file.write(_STROKE_BEGIN_STRUCT.pack(frame_idx, layer_idx,
+                                                     *brush_values))
+
+    def record_sample(self, x, y, pressure, xtilt, ytilt, dtime):
+        # Samples are only buffered, the whole stroke reaches the disk
+        # when it ends.
+        journal_file = self._get_file()
+        journal_file.write(_OPCODE_STRUCT.pack(_STROKE_SAMPLE))
+        journal_file.write(_STROKE_SAMPLE_STRUCT.pack(x, y, pressure,
+                                                      xtilt, ytilt, dtime))
+
+    def end_stroke(self):
+        journal_file = self._get_file()
+        journal_file.write(_OPCODE_STRUCT.pack(_STROKE_END))
+        journal_file.flush()
+        self._stroke_position = None
+
+    def get_position(self):
+        # A stroke in progress is kept whole, so it is replayed from
+        # its beginning.
+        if self._stroke_position is not None:
+            return self._stroke_position
+        if self._file is None:
+            if not os.path.exists(self._path):
+                return 0
+            return os.path.getsize(self._path)
+        self._file.flush()
+        return self._file.tell()
+
+    def truncate(self, position=None):
+        stroke_position = self._stroke_position
+        self._stroke_position = None
+        self.close()
+        if not os.path.exists(self._path):
+            return
+
+        tail = b''
+        if position is not None:
+            position = max(position, _HEADER_SIZE)
+            with open(self._path, 'rb') as journal_file:
+                journal_file.seek(position)
+                tail = journal_file.read()
+
+        if not tail:
+            os.remove(self._path)
+            return
+
+        # The kept records go in a new file that replaces the journal
+        # at once, so a crash leaves either the old or the new one.
+        temp_path = self._path + '.tmp'
+        with open(temp_path, 'wb') as journal_file:
+            journal_file.write(_MAGIC + os.urandom(_GENERATION_SIZE) + tail)
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        os.replace(temp_path, self._path)
+
+        # The stroke in progress moves along with the kept records.
+        if stroke_position is not None:
+            self._stroke_position = (_HEADER_SIZE + stroke_position -
+                                     position)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def read(self, position=None):
+        # Reads the records from a position, or from the start.
+        if not os.path.exists(self._path):
+            return
+
+        with open(self._path, 'rb') as journal_file:
+            data = journal_file.read()
+
+        if not data.startswith(_MAGIC):
+            return
+
+        offset = _HEADER_SIZE
+        if position is not None:
+            offset = max(position, offset)
+        while offset < len(data):
+            opcode = data[offset]
+            if opcode in _DATA_RECORDS:
+                offset += _OPCODE_STRUCT.size
+                if offset + _DATA_LENGTH_STRUCT.size > len(data):
+                    return
+                length, = _DATA_LENGTH_STRUCT.unpack_from(data, offset)
+                offset += _DATA_LENGTH_STRUCT.size
+                if offset + length > len(data):
+                    return
+                yield _DATA_RECORDS[opcode], (json.loads(
+                    data[offset:offset + length].decode('utf-8')),)
+                offset += length
+                continue
+
+            if opcode not in _RECORD_STRUCTS:
+                return
+
+            name, record_struct = _RECORD_STRUCTS[opcode]
+            offset += _OPCODE_STRUCT.size
+            if record_struct is None:
+                yield name, ()
+                continue
+
+            # A crash can leave the last record incomplete.
+            if offset + record_struct.size > len(data):
+                return
+
+            yield name, record_struct.unpack_from(data, offset)
+            offset += record_struct.size
+
+    def replay(self, xsheet, brush):
+        from giutils import get_base_value, set_base_value
+
+        saved_values = [get_base_value(brush, setting)
+                        for setting in _BRUSH_SETTINGS]
+        journal = xsheet.journal
+        xsheet.journal = None
+
+        # If the application stopped after saving but before the
+        # journal started again, the saved records are skipped.
+        position = None
+        if xsheet.saved_journal_position is not None:
+            generation, saved_position = xsheet.saved_journal_position
+            if generation == self.generation:
+                position = saved_position
+
+        with xsheet.frozen():
+            cel = None
+            for name, args in self.read(position):
+                if name == 'stroke-begin':
+                    frame_idx, layer_idx = args[:2]
+                    for setting, value in zip(_BRUSH_SETTINGS, args[2:]):
+                        set_base_value(brush, setting, value)
+                    cel = xsheet.get_cel(frame_idx, layer_idx)
+                    if cel is not None:
+                        old_buffer = cel.snapshot_buffer()
+                        tiles = set()
+                elif name == 'stroke-sample':
+                    if cel is None:
+                        continue
+                    tiles.update(cel.stroke_to(brush, *args))
+                elif name == 'stroke-end':
+                    brush.reset()
+                    if cel is not None:
+                        xsheet.push_stroke(cel, old_buffer, tiles)
+                    cel = None
+                else:
+                    # An edit that can't be done again, like pasting
+                    # what was copied before the last save, is
+                    # skipped so the rest can still be recovered.
+                    try:
+                        getattr(xsheet, name)(*args)
+                    except Exception:
+                        print("Skipping journal record {0} {1}".format(
+                            name, args))
+                        traceback.print_exc()
+
+        # The replayed undos and redos didn't go through the history,
+        # so the edits it got are not the ones that can be undone.
+        xsheet.history.clear()
+
+        brush.reset()
+        for setting, value in zip(_BRUSH_SETTINGS, saved_values):
+            set_base_value(brush, setting, value)
+        xsheet.journal = journal
+
+
+def get_brush_values(brush):
+    from giutils import get_base_value
+
+    return [get_base_value(brush, setting) for setting in _BRUSH_SETTINGS]
+
+
+__test__ = dict(allem="""
+
+The journal records every edit and stroke since the last save, so a
+session can be recovered after a crash.
+
+>>> import tempfile
+>>> tempdir = tempfile.mkdtemp()
+>>> journal = Journal(os.path.join(tempdir, 'test.zip.journal'))
+>>> list(journal.read())
+[]
+
+>>> journal.record_edit('add_cel', 3, 1)
+>>> journal.begin_stroke(3, 1, [0.0, 0.0, 0.0, 0.0, 2.0])
+>>> journal.record_sample(10.0, 20.0, 0.5, 0.0, 0.0, 0.25)
+>>> journal.end_stroke()
+>>> journal.record_edit('scale_timing', 0.5, 0, 1)
+
+>>> for name, args in journal.read():
+...     print(name, args)
+add_cel (3, 1)
+stroke-begin (3, 1, 0.0, 0.0, 0.0, 0.0, 2.0)
+stroke-sample (10.0, 20.0, 0.5, 0.0, 0.0, 0.25)
+stroke-end ()
+scale_timing (0.5, 0, 1)
+
+Undo and redo are recorded as the state they leave, in a document of
+any length:
+
+>>> journal.record_data('restore_entries', {'layer': 1, 'first': 3})
+>>> list(journal.read())[-1]
+('restore_entries', ({'layer': 1, 'first': 3},))
+
+If the last record was not completely written, it is ignored:
+
+>>> journal.record_edit('cut', 3, 1)
+>>> journal.close()
+>>> with open(journal.path, 'rb+') as journal_file:
+...     size = journal_file.seek(-1, os.SEEK_END)
+...     size = journal_file.truncate()
+
+>>> [name for name, args in journal.read()]
+['add_cel', 'stroke-begin', 'stroke-sample', 'stroke-end', 'scale_timing', 'restore_entries']
+
+After saving, the journal starts again:
+
+>>> journal.truncate()
+>>> list(journal.read())
+[]
+
+When the save runs in the background, only the records written before
+it started are dropped:
+
+>>> journal.record_edit('add_cel', 5, 0)
+>>> position = journal.get_position()
+>>> journal.record_edit('remove_clear', 5, 0)
+>>> journal.truncate(position)
+>>> list(journal.read())
+[('remove_clear', (5, 0))]
+
+A stroke in progress keeps its place in the journal, so saving again
+in the middle of it drops the records before it:
+
+>>> position = journal.get_position()
+>>> journal.record_edit('paste', 5, 0)
+>>> journal.begin_stroke(5, 0, [0.0, 0.0, 0.0, 0.0, 2.0])
+>>> journal.truncate(position)
+>>> journal.truncate(journal.get_position())
+>>> journal.record_sample(10.0, 20.0, 0.5, 0.0, 0.0, 0.25)
+>>> journal.end_stroke()
+>>> [name for name, args in journal.read()]
+['stroke-begin', 'stroke-sample', 'stroke-end']
+
+>>> journal.truncate()
+
+A save stores the generation of the journal and the position it
+covers.  If the journal was not truncated after saving, the saved
+records can be skipped:
+
+>>> journal.record_edit('add_cel', 5, 0)
+>>> generation = journal.generation
+>>> position = journal.get_position()
+>>> journal.record_edit('remove_clear', 5, 0)
+>>> list(journal.read(position))
+[('remove_clear', (5, 0))]
+
+Once truncated, the journal has a new generation, so a position from
+before doesn't apply to it:
+
+>>> journal.truncate(position)
+>>> journal.generation != generation
+True
+
+>>> list(journal.read())
+[('remove_clear', (5, 0))]
+
+>>> journal.truncate()
+
+>>> os.rmdir(tempdir)
+
+""")
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -8,6 +8,7 @@ class Metronome(object):
         Gst.init([])
         self._xsheet = xsheet
         self._frame_changed_hid = None
+        self._last_frame = None
 
         self._player = Gst.ElementFactory.make("playbin", "tick")
         fakesink = Gst.ElementFactory.make("fakesink", "fake")
@@ -27,6 +28,7 @@ class Metronome(object):
         if self._frame_changed_hid is not None:
             return False
 
+        self._last_frame = None
         self._frame_changed_hid = self._xsheet.connect('frame-changed',
                                                        self._xsheet_changed_cb)
         return True
@@ -59,7 +61,19 @@ class Metronome(object):
         self._player.set_state(Gst.State.NULL)
 
     def _xsheet_changed_cb(self, xsheet):
-        if xsheet.current_frame % 24 == 0:
+        # Playback drops the frames that are late, so the beats that
+        # fell between the presented frames are ticked too.
+        frame = xsheet.current_frame
+        previous_frame = frame - 1
+        if (xsheet.is_playing and self._last_frame is not None and
+                self._last_frame < frame):
+            previous_frame = self._last_frame
+        self._last_frame = frame
+
+        def crosses_beat(beat):
+            return frame // beat != previous_frame // beat
+
+        if crosses_beat(24):
             self._tick(self._strong_tick_sound_path)
-        elif xsheet.current_frame % xsheet.frames_separation == 0:
+        elif crosses_beat(xsheet.frames_separation):
             self._tick(self._soft_tick_sound_path)
@@ -0,0 +1,215 @@
+import math
+from fractions import Fraction
+
+DEFAULT_FPS = Fraction(24)
+
+_MICROSECONDS = 1000000
+
+
+def _percentile(sorted_values, fraction):
+    idx = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[idx]
+
+
+class Playback(object):
+    # The clock is GLib, or anything with its get_monotonic_time,
+    # timeout_add and source_remove functions.
+    def __init__(self, present_cb, clock, fps=DEFAULT_FPS):
+        self.fps = Fraction(fps)
+        self._present_cb = present_cb
+        self._clock = clock
+        self._playing = False
+        self._hid = None
+        self._start_time = 0
+        self._start_frame = 0
+        self._loop_range = None
+        self._position = 0
+        self._last_present_time = 0
+        self._intervals = []
+        self._dropped = 0
+
+    @property
+    def is_playing(self):
+        return self._playing
+
+    def start(self, frame, loop_range=None):
+        if self._playing:
+            return False
+
+        self._playing = True
+        self.reset(frame, loop_range, self._clock.get_monotonic_time())
+        self._schedule(self._clock.get_monotonic_time())
+        return True
+
+    def stop(self):
+        if not self._playing:
+            return False
+
+        self._playing = False
+        self._clock.source_remove(self._hid)
+        self._hid = None
+        return True
+
+    def reset(self, frame, loop_range, now):
+        self._start_time = now
+        self._start_frame = frame
+        self._loop_range = loop_range
+        self._position = 0
+        self._last_present_time = now
+        self._intervals = []
+        self._dropped = 0
+
+    def get_frame(self, position):
+        frame = self._start_frame + position
+        if self._loop_range is None:
+            return frame
+
+        first, last = self._loop_range
+        return first + (frame - first) % (last - first + 1)
+
+    def get_upcoming_frames(self, count):
+        return [self.get_frame(self._position + i)
+                for i in range(1, count + 1)]
+
+    def advance(self, now):
+        # The frame comes from the time elapsed since playback started,
+        # so a slow frame doesn't delay the following ones.  Frames
+        # that are already late are dropped.
+        position = int((now - self._start_time) * self.fps // _MICROSECONDS)
+        if position <= self._position:
+            return None
+
+        self._dropped += position - self._position - 1
+        self._position = position
+        self._intervals.append(now - self._last_present_time)
+        self._last_present_time = now
+        return self.get_frame(position)
+
+    def get_next_time(self):
+        return self._start_time + int(math.ceil(
+            (self._position + 1) * _MICROSECONDS / self.fps))
+
+    def get_stats(self):
+        if not self._intervals:
+            return None
+
+        intervals = sorted(self._intervals)
+        elapsed = self._last_present_time - self._start_time
+        return {
+            'fps': len(intervals) * _MICROSECONDS / float(elapsed),
+            'frames': len(intervals),
+            'dropped': self._dropped,
+            'interval_p50': _percentile(intervals, 0.5) / 1000.0,
+            'interval_p99': _percentile(intervals, 0.99) / 1000.0,
+        }
+
+    def _schedule(self, now):
+        delay = int(math.ceil((self.get_next_time() - now) / 1000.0))
+        self._hid = self._clock.timeout_add(max(0, delay), self._tick_cb)
+
+    def _tick_cb(self):
+        frame = self.advance(self._clock.get_monotonic_time())
+        if frame is not None:
+            self._present_cb(frame)
+
+        if self._playing:
+            self._schedule(self._clock.get_monotonic_time())
+        return False
+
+
+__test__ = dict(allem="""
+
+Playback presents frames following a monotonic clock, in
+microseconds.  The frame rate is a fraction, so rates like 24000/1001
+are exact.  This clock is moved by hand:
+
+>>> class FakeClock(object):
+...     def __init__(self):
+...         self.now = 0
+...         self.timeouts = {}
+...     def get_monotonic_time(self):
+...         return self.now
+...     def timeout_add(self, delay, callback):
+...         hid = len(self.timeouts) + 1
+...         self.timeouts[hid] = (delay, callback)
+...         return hid
+...     def source_remove(self, hid):
+...         del self.timeouts[hid]
+...     def get_delays(self):
+...         return [delay for delay, callback in self.timeouts.values()]
+...     def run_timeouts(self):
+...         timeouts = list(self.timeouts.values())
+...         self.timeouts.clear()
+...         for delay, callback in timeouts:
+...             callback()
+
+>>> presented = []
+>>> clock = FakeClock()
+>>> playback = Playback(presented.append, clock, fps=24)
+>>> playback.reset(10, None, now=0)
+>>> playback.advance(20000) is None
+True
+
+>>> playback.advance(41667)
+11
+
+>>> playback.get_next_time()
+83334
+
+If presenting a frame took too long, the frames that are already late
+are dropped:
+
+>>> playback.advance(150000)
+13
+
+>>> playback.advance(170000)
+14
+
+>>> stats = playback.get_stats()
+>>> stats['frames'], stats['dropped']
+(3, 1)
+
+>>> round(stats['fps'], 2)
+17.65
+
+>>> stats['interval_p50'], stats['interval_p99']
+(41.667, 108.333)
+
+Started, playback waits until the next frame is due, in milliseconds,
+and presents it:
+
+>>> playback.start(0)
+True
+
+>>> clock.get_delays()
+[42]
+
+>>> clock.now = 41667
+>>> clock.run_timeouts()
+>>> presented
+[1]
+
+>>> clock.get_delays()
+[42]
+
+>>> playback.stop()
+True
+
+>>> clock.get_delays()
+[]
+
+When looping, the frames go back to the first one after the last:
+
+>>> playback.reset(2, (2, 4), now=0)
+>>> [playback.advance(int(i * 1000000 / 24) + 1) for i in range(1, 5)]
+[3, 4, 2, 3]
+
+>>> playback.get_upcoming_frames(4)
+[4, 2, 3, 4]
+
+""")
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
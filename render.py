@@ -0,0 +1,246 @@
+import os
+import sys
+import shutil
+import argparse
+import collections
+import multiprocessing
+from fractions import Fraction
+
+from gi.repository import GLib
+from gi.repository import GdkPixbuf
+from gi.repository import Gegl
+
+from xsheet import XSheet, PIXELS_FORMAT
+from composite import render_cels, get_cels_extent
+
+DEFAULT_PATTERN = "frame-{0:05d}.png"
+
+# Frames rendered ahead of the one being consumed, per process.
+_FRAMES_AHEAD = 2
+
+# Each worker process loads its own copy of the project.
+_worker_xsheet = None
+
+
+def _init_worker(filename):
+    global _worker_xsheet
+
+    Gegl.init([])
+    _worker_xsheet = XSheet()
+    _worker_xsheet.load(filename)
+
+
+def get_frame_cels(xsheet, frame_idx):
+    cels = [xsheet.get_cel(frame_idx, layer_idx)
+            for layer_idx in range(xsheet.layers_length)]
+    return [cel for cel in cels if cel is not None]
+
+
+def get_frame_pixels(xsheet, frame_idx, rect, background=None):
+    frame_buffer = render_cels(get_frame_cels(xsheet, frame_idx), rect,
+                               background)
+    return frame_buffer.get(frame_buffer.get_extent(), 1.0, PIXELS_FORMAT,
+                            Gegl.AbyssPolicy.NONE)
+
+
+def get_camera(xsheet, first_frame, last_frame):
+    # Without a camera, the frames cover every cel in the range, so
+    # all of them have the same size.
+    cels = set()
+    for frame_idx in range(first_frame, last_frame + 1):
+        cels.update(get_frame_cels(xsheet, frame_idx))
+    return get_cels_extent(list(cels))
+
+
+def _save_png(pixels, width, height, path):
+    pixbuf = GdkPixbuf.Pixbuf.new_from_bytes(
+        GLib.Bytes.new(pixels), GdkPixbuf.Colorspace.RGB, True, 8,
+        width, height, width * 4)
+    pixbuf.savev(path, 'png', [], [])
+
+
+def _render_frame(job):
+    frame_idx, rect, path = job
+    pixels = get_frame_pixels(_worker_xsheet, frame_idx, rect)
+    _save_png(pixels, rect[2], rect[3], path)
+    return frame_idx
+
+
+def _render_frame_pixels(job):
+    frame_idx, rect, background = job
+    return get_frame_pixels(_worker_xsheet, frame_idx, rect, background)
+
+
+def _create_pool(filename, processes):
+    # Worker processes are spawned, not forked, so they start with
+    # GEGL and the introspection bindings clean.
+    context = multiprocessing.get_context('spawn')
+    return context.Pool(processes, _init_worker, (filename,))
+
+
+def iter_frame_pixels(filename, xsheet, first_frame, last_frame, camera,
+                      processes=None, background=None):
+    # Yields the pixels of each frame in order.  Only a few frames are
+    # rendered ahead, so memory doesn't grow with the length of the
+    # shot.  A held frame yields the pixels of the previous one again.
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    pool = _create_pool(filename, processes)
+    pending = collections.deque()
+    frames = iter(range(first_frame, last_frame + 1))
+    last_key = None
+    try:
+        while True:
+            while len(pending) < processes * _FRAMES_AHEAD:
+                frame_idx = next(frames, None)
+                if frame_idx is None:
+                    break
+                key = tuple(get_frame_cels(xsheet, frame_idx))
+                if key == last_key:
+                    pending.append(None)
+                    continue
+                last_key = key
+                pending.append(pool.apply_async(
+                    _render_frame_pixels,
+                    ((frame_idx, camera, background),)))
+
+            if not pending:
+                break
+
+            result = pending.popleft()
+            if result is not None:
+                pixels = result.get()
+            yield pixels
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def get_unique_frames(xsheet, first_frame, last_frame):
+    # Frames showing the same cels are rendered once.  Returns the
+    # frames to render and, for each frame, the frame it repeats.
+    unique_frames = []
+    repeated = {}
+    frame_keys = {}
+    for frame_idx in range(first_frame, last_frame + 1):
+        key = tuple(get_frame_cels(xsheet, frame_idx))
+        if key in frame_keys:
+            repeated[frame_idx] = frame_keys[key]
+        else:
+            frame_keys[key] = frame_idx
+            unique_frames.append(frame_idx)
+
+    return unique_frames, repeated
+
+
+def load(filename, first=None, last=None, camera=None):
+    xsheet = XSheet()
+    xsheet.load(filename)
+
+    first_frame, last_frame = xsheet.get_extent()
+    if first is not None:
+        first_frame = first
+    if last is not None:
+        last_frame = last
+    if camera is None:
+        camera = get_camera(xsheet, first_frame, last_frame)
+    if camera[2] <= 0 or camera[3] <= 0:
+        raise ValueError("Nothing to render")
+
+    return xsheet, first_frame, last_frame, camera
+
+
+def render(filename, output_dir, first=None, last=None, camera=None,
+           processes=None, pattern=DEFAULT_PATTERN, out=sys.stdout):
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    xsheet, first_frame, last_frame, camera = load(filename, first, last,
+                                                   camera)
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    def get_path(frame_idx):
+        # Frames are numbered from 1, as in the timeline.
+        return os.path.join(output_dir, pattern.format(frame_idx + 1))
+
+    unique_frames, repeated = get_unique_frames(xsheet, first_frame,
+                                                last_frame)
+    jobs = [(frame_idx, camera, get_path(frame_idx))
+            for frame_idx in unique_frames]
+
+    pool = _create_pool(filename, processes)
+    try:
+        for done, frame_idx in enumerate(pool.imap_unordered(_render_frame,
+                                                             jobs)):
+            out.write("Rendered frame {0} ({1}/{2})\n".format(
+                frame_idx + 1, done + 1, len(jobs)))
+    finally:
+        pool.close()
+        pool.join()
+
+    for frame_idx, source_frame_idx in sorted(repeated.items()):
+        shutil.copyfile(get_path(source_frame_idx), get_path(frame_idx))
+
+    return last_frame - first_frame + 1
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Render the frames of an xsheet as a PNG sequence "
+        "or a video.")
+    parser.add_argument('filename', help="project file")
+    parser.add_argument('output', help="output directory, or video file")
+    parser.add_argument('--first', type=int, default=None,
+                        help="first frame, counting from 1")
+    parser.add_argument('--last', type=int, default=None,
+                        help="last frame, counting from 1")
+    parser.add_argument('--camera', type=int, nargs=4, default=None,
+                        metavar=('X', 'Y', 'WIDTH', 'HEIGHT'),
+                        help="rectangle of the canvas to render, by "
+                        "default the extent of all the cels")
+    parser.add_argument('--processes', type=int, default=None,
+                        help="number of render processes, by default "
+                        "one per CPU")
+    parser.add_argument('--pattern', default=DEFAULT_PATTERN,
+                        help="file name of each frame, formatted with "
+                        "the frame number")
+    parser.add_argument('--video', action='store_true',
+                        help="encode a video file named as the output, "
+                        "instead of a PNG sequence")
+    parser.add_argument('--fps', type=Fraction, default=None,
+                        help="frame rate of the video, like 24 or "
+                        "24000/1001, by default the one of the project")
+    parser.add_argument('--codec', default=None,
+                        help="video codec, by default the first available "
+                        "of vp8, theora and ffv1")
+    args = parser.parse_args(argv)
+
+    Gegl.init([])
+
+    first = None
+    if args.first is not None:
+        first = args.first - 1
+    last = None
+    if args.last is not None:
+        last = args.last - 1
+
+    try:
+        if args.video:
+            from videoexport import export_video
+            export_video(args.filename, args.output, first, last,
+                         args.camera, args.fps, args.codec, args.processes)
+        else:
+            render(args.filename, args.output, first, last, args.camera,
+                   args.processes, args.pattern)
+    except ValueError as error:
+        sys.stderr.write("{0}\n".format(error))
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
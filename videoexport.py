@@ -0,0 +1,109 @@
+from gi.repository import Gst
+
+from render import load, iter_frame_pixels
+
+# Codecs by preference: name, encoder and muxer elements.
+_CODECS = [
+    ('vp8', 'vp8enc', 'webmmux'),
+    ('theora', 'theoraenc', 'oggmux'),
+    ('ffv1', 'avenc_ffv1', 'matroskamux'),
+]
+
+# The encoder only gets a few frames ahead of the renderer.
+_QUEUE_FRAMES = 4
+
+# Video formats have no alpha, so the frames are put over the same
+# background as the canvas.
+_BACKGROUND = "white"
+
+
+def get_available_codecs():
+    Gst.init([])
+    return [name for name, encoder, muxer in _CODECS
+            if Gst.ElementFactory.find(encoder) is not None and
+            Gst.ElementFactory.find(muxer) is not None]
+
+
+def _make_element(factory_name):
+    element = Gst.ElementFactory.make(factory_name, None)
+    if element is None:
+        raise ValueError("Missing GStreamer element {0}".format(
+            factory_name))
+    return element
+
+
+def _create_pipeline(filename, width, height, fps, codec):
+    available = get_available_codecs()
+    if codec is None:
+        if not available:
+            raise ValueError("No video encoder available")
+        codec = available[0]
+    elif codec not in available:
+        raise ValueError("Video codec {0} not available".format(codec))
+
+    encoder_name, muxer_name = [(encoder, muxer) for name, encoder, muxer
+                                in _CODECS if name == codec][0]
+
+    pipeline = Gst.Pipeline()
+    source = _make_element('appsrc')
+    caps = Gst.Caps.from_string(
+        "video/x-raw,format=RGBA,width={0},height={1},"
+        "framerate={2}/{3}".format(width, height, fps.numerator,
+                                   fps.denominator))
+    source.set_property('caps', caps)
+    source.set_property('format', Gst.Format.TIME)
+    source.set_property('block', True)
+    source.set_property('max-bytes', width * height * 4 * _QUEUE_FRAMES)
+
+    elements = [source, _make_element('videoconvert'),
+                _make_element(encoder_name), _make_element(muxer_name),
+                _make_element('filesink')]
+    elements[-1].set_property('location', filename)
+
+    for element in elements:
+        pipeline.add(element)
+    for element, next_element in zip(elements, elements[1:]):
+        element.link(next_element)
+
+    return pipeline, source
+
+
+def export_video(filename, output, first=None, last=None, camera=None,
+                 fps=None, codec=None, processes=None):
+    xsheet, first_frame, last_frame, camera = load(filename, first, last,
+                                                   camera)
+    if fps is None:
+        fps = xsheet.fps
+
+    # Encoders expect even sizes.
+    width = camera[2] + camera[2] % 2
+    height = camera[3] + camera[3] % 2
+    camera = [camera[0], camera[1], width, height]
+
+    pipeline, source = _create_pipeline(output, width, height, fps, codec)
+    pipeline.set_state(Gst.State.PLAYING)
+    bus = pipeline.get_bus()
+
+    try:
+        frames = iter_frame_pixels(filename, xsheet, first_frame, last_frame,
+                                   camera, processes, _BACKGROUND)
+        for idx, pixels in enumerate(frames):
+            # The timestamps come from the frame rate, so they don't
+            # accumulate rounding errors.
+            buf = Gst.Buffer.new_wrapped(pixels)
+            buf.pts = Gst.util_uint64_scale(idx, Gst.SECOND * fps.denominator,
+                                            fps.numerator)
+            buf.duration = Gst.util_uint64_scale(
+                idx + 1, Gst.SECOND * fps.denominator,
+                fps.numerator) - buf.pts
+            if source.emit('push-buffer', buf) != Gst.FlowReturn.OK:
+                break
+
+        source.emit('end-of-stream')
+        message = bus.timed_pop_filtered(
+            Gst.CLOCK_TIME_NONE, Gst.MessageType.EOS | Gst.MessageType.ERROR)
+        if message.type == Gst.MessageType.ERROR:
+            error, debug = message.parse_error()
+            raise ValueError("Video export failed: {0}".format(error.message))
+    finally:
+        pipeline.set_state(Gst.State.NULL)
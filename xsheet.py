@@ -1,77 +1,255 @@
 import os
+import math
 import json
+import zlib
+import base64
+import queue
+import hashlib
 import zipfile
-import tempfile
-
+import threading
+import traceback
+import contextlib
+import multiprocessing
+from fractions import Fraction
+from concurrent.futures import ThreadPoolExecutor
+
+from gi.repository import GLib
 from gi.repository import GObject
+from gi.repository import GdkPixbuf
 from gi.repository import MyPaintGegl
 from gi.repository import Gegl
 
 from framelist import FrameList
+from archive import Archive
+from history import History, StrokeEdit, CallbackEdit
+from playback import Playback, DEFAULT_FPS
+
+PIXELS_FORMAT = "R'G'B'A u8"
+DECODE_BATCH_INTERVAL = 100
+FORMAT_VERSION = 2
+TILE_SIZE = 64
+
+_EMPTY_TILE_ALPHA = bytes(TILE_SIZE * TILE_SIZE)
+
+# Rough size of a (frame, value) pair kept by a structural edit.
+_ENTRY_SIZE = 16
+
+
+def _new_rectangle(x, y, width, height):
+    rect = Gegl.Rectangle()
+    rect.x = x
+    rect.y = y
+    rect.width = width
+    rect.height = height
+    return rect
+
+
+def _get_tile_path(tile_hash):
+    return "tiles/{0}".format(tile_hash)
+
+
+def _get_rect_tiles(x, y, width, height):
+    first_x = x // TILE_SIZE * TILE_SIZE
+    first_y = y // TILE_SIZE * TILE_SIZE
+    return set((tile_x, tile_y)
+               for tile_y in range(first_y, y + height, TILE_SIZE)
+               for tile_x in range(first_x, x + width, TILE_SIZE))
+
+
+def _get_buffer_tiles(cel_buffer):
+    rect = cel_buffer.get_extent()
+    first_x = rect.x // TILE_SIZE * TILE_SIZE
+    first_y = rect.y // TILE_SIZE * TILE_SIZE
+
+    tiles = []
+    for tile_y in range(first_y, rect.y + rect.height, TILE_SIZE):
+        for tile_x in range(first_x, rect.x + rect.width, TILE_SIZE):
+            tile_rect = _new_rectangle(tile_x, tile_y, TILE_SIZE, TILE_SIZE)
+            pixels = cel_buffer.get(tile_rect, 1.0, PIXELS_FORMAT,
+                                    Gegl.AbyssPolicy.NONE)
+            if pixels[3::4] != _EMPTY_TILE_ALPHA:
+                tiles.append((tile_x, tile_y, pixels))
+
+    return tiles
+
+
+def _encode_tile(pixels):
+    return hashlib.sha1(pixels).hexdigest(), zlib.compress(pixels)
 
-FPMS = 42
+
+def _encode_regions(regions):
+    return [[x, y, width, height,
+             base64.b64encode(zlib.compress(pixels)).decode('ascii')]
+            for x, y, width, height, pixels in regions]
+
+
+def _decode_regions(regions_data):
+    return [(x, y, width, height, zlib.decompress(base64.b64decode(data)))
+            for x, y, width, height, data in regions_data]
+
+
+def _decode_png(png_data):
+    loader = GdkPixbuf.PixbufLoader.new_with_type('png')
+    # The introspection bindings only take bytes, this is the single
+    # copy of the mapped archive data.
+    loader.write(bytes(png_data))
+    loader.close()
+    pixbuf = loader.get_pixbuf()
+    if not pixbuf.get_has_alpha():
+        pixbuf = pixbuf.add_alpha(False, 0, 0, 0)
+
+    width = pixbuf.get_width()
+    height = pixbuf.get_height()
+    rowstride = pixbuf.get_rowstride()
+    pixels = pixbuf.get_pixels()
+    if rowstride != width * 4:
+        pixels = b''.join(pixels[row * rowstride:row * rowstride + width * 4]
+                          for row in range(height))
+    return width, height, pixels
 
 
 class Cel(object):
     def __init__(self):
         graph = Gegl.Node()
-        self.gegl_surface = MyPaintGegl.TiledSurface()
-        self.surface = self.gegl_surface.interface()
-        self.surface_node = graph.create_child("gegl:buffer-source")
-        self.surface_node.set_property("buffer", self.gegl_surface.get_buffer())
+        self._gegl_surface = MyPaintGegl.TiledSurface()
+        self._surface = self._gegl_surface.interface()
+        self._surface_node = graph.create_child("gegl:buffer-source")
+        self._surface_node.set_property("buffer",
+                                        self._gegl_surface.get_buffer())
+        self._decoded = True
+        self.dirty = True
+        self.revision = 0
+        self.archive = None
+        self.archive_path = None
+        self.archive_tiles = None
 
-    def save_png(self, path_png):
-        graph = Gegl.Node()
-        save = graph.create_child("gegl:png-save")
-        save.set_property('path', path_png)
-        self.surface_node.connect_to("output", save, "input")
-        save.process()
+    @property
+    def gegl_surface(self):
+        self.decode()
+        return self._gegl_surface
 
-    def load_png(self, path_png):
-        cel_buffer = self.gegl_surface.get_buffer()
-        graph = Gegl.Node()
-        load = graph.create_child("gegl:load")
-        load.set_property('path', path_png)
-        translate = graph.create_child("gegl:translate")
-        translate.set_property('x', cel_buffer.props.x)
-        translate.set_property('y', cel_buffer.props.y)
-        write = graph.create_child("gegl:write-buffer")
-        write.set_property('buffer', cel_buffer)
-        load.connect_to("output", translate, "input")
-        translate.connect_to("output", write, "input")
-        write.process()
-        self.surface_node.process()
+    @property
+    def surface(self):
+        self.decode()
+        return self._surface
+
+    @property
+    def surface_node(self):
+        self.decode()
+        return self._surface_node
+
+    @property
+    def is_decoded(self):
+        return self._decoded
+
+    def mark_dirty(self):
+        self.dirty = True
+        self.revision += 1
+
+    def set_archived(self, archive, path=None, tiles=None):
+        self.dirty = False
+        self.archive = archive
+        self.archive_path = path
+        self.archive_tiles = tiles
+
+    def defer_decode(self):
+        assert self.archive is not None
+        self._decoded = False
+
+    def decode(self, regions=None):
+        if self._decoded:
+            return
+
+        self._decoded = True
+        if regions is None:
+            regions = self.read_archived_regions()
+        self.set_regions(regions)
+
+    def read_archived_regions(self):
+        if self.archive_tiles is not None:
+            return [(x, y, TILE_SIZE, TILE_SIZE,
+                     zlib.decompress(self.archive.read(
+                         _get_tile_path(tile_hash))))
+                    for x, y, tile_hash in self.archive_tiles]
+
+        # Projects saved before the tiles format store one PNG per
+        # cel, covering the cel extent.
+        x, y, width, height = self.extent_to_data()
+        if width == 0 or height == 0:
+            return []
+
+        png_data = self.archive.read(self.archive_path)
+        return [(x, y) + _decode_png(png_data)]
+
+    def set_regions(self, regions):
+        cel_buffer = self._gegl_surface.get_buffer()
+        for x, y, width, height, pixels in regions:
+            rect = _new_rectangle(x, y, width, height)
+            cel_buffer.set(rect, PIXELS_FORMAT, pixels)
+        self._surface_node.process()
+
+    def stroke_to(self, brush, x, y, pressure, xtilt, ytilt, dtime):
+        # Returns the tiles that the dabs of this sample touched, as
+        # reported by the surface, wherever the brush dynamics put
+        # them.
+        surface = self.surface
+        surface.begin_atomic()
+        brush.stroke_to(surface, x, y, pressure, xtilt, ytilt, dtime)
+        rect = surface.end_atomic()
+        self.mark_dirty()
+        return _get_rect_tiles(rect.x, rect.y, rect.width, rect.height)
+
+    def get_changed_regions(self, old_buffer, tiles):
+        cel_buffer = self._gegl_surface.get_buffer()
+        regions_before = []
+        regions_after = []
+        for tile_x, tile_y in sorted(tiles):
+            rect = _new_rectangle(tile_x, tile_y, TILE_SIZE, TILE_SIZE)
+            old_pixels = old_buffer.get(rect, 1.0, PIXELS_FORMAT,
+                                        Gegl.AbyssPolicy.NONE)
+            pixels = cel_buffer.get(rect, 1.0, PIXELS_FORMAT,
+                                    Gegl.AbyssPolicy.NONE)
+            if pixels != old_pixels:
+                regions_before.append((tile_x, tile_y, TILE_SIZE,
+                                       TILE_SIZE, old_pixels))
+                regions_after.append((tile_x, tile_y, TILE_SIZE,
+                                      TILE_SIZE, pixels))
+
+        return regions_before, regions_after
+
+    def snapshot_buffer(self):
+        return self.gegl_surface.get_buffer().dup()
+
+    def _set_buffer(self, cel_buffer):
+        self._gegl_surface.set_buffer(cel_buffer)
+        self._surface_node.set_property("buffer", cel_buffer)
 
     def copy(self):
         new_cel = Cel()
 
-        cel_buffer = self.gegl_surface.get_buffer()
-        new_buffer = new_cel.gegl_surface.get_buffer()
-        new_buffer.set_extent(cel_buffer.get_extent())
+        # GEGL shares the tiles of a duplicated buffer until one of
+        # the two buffers writes to them.  A cel that was not decoded
+        # yet shares the archived data instead.
+        if self._decoded:
+            new_cel._set_buffer(self._gegl_surface.get_buffer().dup())
 
-        translate = graph.create_child("gegl:translate")
-        translate.set_property('x', cel_buffer.props.x)
-        translate.set_property('y', cel_buffer.props.y)
-        write = graph.create_child("gegl:write-buffer")
-        write.set_property('buffer', cel_buffer)
-        load.connect_to("output", translate, "input")
-        translate.connect_to("output", write, "input")
-        write.process()
+        if not self.dirty:
+            new_cel.set_archived(self.archive, self.archive_path,
+                                 self.archive_tiles)
+
+        if not self._decoded:
+            new_cel.extent_from_data(self.extent_to_data())
+            new_cel.defer_decode()
 
         return new_cel
 
     def extent_to_data(self):
-        rect = self.gegl_surface.get_buffer().get_extent()
+        rect = self._gegl_surface.get_buffer().get_extent()
         return [rect.x, rect.y, rect.width, rect.height]
 
     def extent_from_data(self, data):
-        rect = Gegl.Rectangle()
-        rect.x = data[0]
-        rect.y = data[1]
-        rect.width = data[2]
-        rect.height = data[3]
-
-        cel_buffer = self.gegl_surface.get_buffer()
+        rect = _new_rectangle(*data)
+        cel_buffer = self._gegl_surface.get_buffer()
         cel_buffer.set_extent(rect)
 
 
@@ -80,6 +258,10 @@ class XSheet(GObject.GObject):
         "frame-changed": (GObject.SignalFlags.RUN_FIRST, None, []),
         "layer-changed": (GObject.SignalFlags.RUN_FIRST, None, []),
         "cursor-changed": (GObject.SignalFlags.RUN_FIRST, None, []),
+        "load-progress": (GObject.SignalFlags.RUN_FIRST, None, [int, int]),
+        "save-progress": (GObject.SignalFlags.RUN_FIRST, None, [int, int]),
+        "save-finished": (GObject.SignalFlags.RUN_FIRST, None, [bool]),
+        "loop-changed": (GObject.SignalFlags.RUN_FIRST, None, []),
     }
 
     def __init__(self, layers_length=3):
@@ -87,13 +269,29 @@ class XSheet(GObject.GObject):
 
         self.current_frame = 0
         self.layer_idx = 0
-        self._play_hid = None
+        self.playback = Playback(self._play_frame_cb, GLib)
         self.layers = None
         self._edit_cel = None
+        self._decode_job = None
+        self._save_job = None
+        self.journal = None
+        self.saved_journal_position = None
+        self.history = History()
+        self.coalesce_signals = False
+        self._pending_signals = {'frame-changed': False,
+                                 'layer-changed': False}
+        self._freeze_count = 0
+        self._flush_hid = None
         self._setup(layers_length)
 
     def _setup(self, layers_length):
+        self._stop_decoding()
+        self.history.clear()
         self.layers = [FrameList() for x in range(layers_length)]
+        self._layer_extents = [None] * layers_length
+        self._extent = None
+        self._loop_in = None
+        self._loop_out = None
 
     def get_layers(self):
         return self.layers
@@ -104,7 +302,7 @@ class XSheet(GObject.GObject):
 
     @property
     def is_playing(self):
-        return self._play_hid is not None
+        return self.playback.is_playing
 
     @property
     def layers_length(self):
@@ -114,6 +312,14 @@ class XSheet(GObject.GObject):
     def frames_separation(self):
         return 6
 
+    @property
+    def fps(self):
+        return self.playback.fps
+
+    @fps.setter
+    def fps(self, fps):
+        self.playback.fps = Fraction(fps)
+
     def go_to_frame(self, frame_idx):
         cant_go = (frame_idx < 0 or frame_idx == self.current_frame)
         if cant_go:
@@ -126,8 +332,9 @@ class XSheet(GObject.GObject):
 
     def previous_frame(self, loop=False):
         if loop:
-            if self.current_frame == self._get_first_frame():
-                self.current_frame = self._get_last_frame()
+            first_frame, last_frame = self.get_loop_range()
+            if self.current_frame == first_frame:
+                self.current_frame = last_frame
                 return True
 
         if self.current_frame == 0:
@@ -140,8 +347,9 @@ class XSheet(GObject.GObject):
 
     def next_frame(self, loop=False):
         if loop:
-            if self.current_frame == self._get_last_frame():
-                self.current_frame = self._get_first_frame() - 1
+            first_frame, last_frame = self.get_loop_range()
+            if self.current_frame == last_frame:
+                self.current_frame = first_frame - 1
                 return True
 
         self.current_frame += 1
@@ -150,24 +358,29 @@ class XSheet(GObject.GObject):
         return True
 
     def play(self, loop=False):
-        if self._play_hid is not None:
+        if self.playback.is_playing:
             return False
 
+        loop_range = None
         if loop:
-            self.current_frame = self._get_first_frame()
+            loop_range = self.get_loop_range()
+            self.current_frame = loop_range[0]
             self._emit_signals(frame_changed=True)
 
-        self._play_hid = GObject.timeout_add(FPMS, self.next_frame, loop)
-        return True
+        return self.playback.start(self.current_frame, loop_range)
 
     def stop(self):
-        if self._play_hid is None:
+        if not self.playback.stop():
             return False
 
-        GObject.source_remove(self._play_hid)
-        self._play_hid = None
+        # The views go back from the playback frames to the layers.
+        self._emit_signals(frame_changed=True)
         return True
 
+    def _play_frame_cb(self, frame_idx):
+        self.current_frame = frame_idx
+        self._emit_signals(frame_changed=True)
+
     def previous_layer(self):
         if self.layer_idx == 0:
             return False
@@ -186,6 +399,69 @@ class XSheet(GObject.GObject):
         self._emit_signals(layer_changed=True)
         return True
 
+    def get_layer_extent(self, layer_idx):
+        # The extents are kept until the FrameList changes its version,
+        # so a playback tick doesn't walk the layers again.
+        layer = self.layers[layer_idx]
+        cached = self._layer_extents[layer_idx]
+        if cached is None or cached[0] != layer.version:
+            extent = None
+            if layer.get_first_frame() is not None:
+                extent = (layer.get_first_frame(), layer.get_last_frame())
+            cached = (layer.version, extent)
+            self._layer_extents[layer_idx] = cached
+
+        return cached[1]
+
+    def get_extent(self):
+        versions = tuple(layer.version for layer in self.layers)
+        if self._extent is None or self._extent[0] != versions:
+            extents = [self.get_layer_extent(layer_idx)
+                       for layer_idx in range(self.layers_length)]
+            extents = [extent for extent in extents if extent is not None]
+            extent = (0, 0)
+            if extents:
+                extent = (min(first for first, last in extents),
+                          max(last for first, last in extents))
+            self._extent = (versions, extent)
+
+        return self._extent[1]
+
+    @property
+    def loop_markers(self):
+        return self._loop_in, self._loop_out
+
+    def get_loop_range(self):
+        first_frame, last_frame = self.get_extent()
+        if self._loop_in is not None:
+            first_frame = self._loop_in
+        if self._loop_out is not None:
+            last_frame = self._loop_out
+        return first_frame, max(first_frame, last_frame)
+
+    def set_loop_in(self, frame_idx=None):
+        if frame_idx is None:
+            frame_idx = self.current_frame
+
+        self._loop_in = frame_idx
+        if self._loop_out is not None and self._loop_out < frame_idx:
+            self._loop_out = None
+        self.emit("loop-changed")
+
+    def set_loop_out(self, frame_idx=None):
+        if frame_idx is None:
+            frame_idx = self.current_frame
+
+        self._loop_out = frame_idx
+        if self._loop_in is not None and self._loop_in > frame_idx:
+            self._loop_in = None
+        self.emit("loop-changed")
+
+    def clear_loop(self):
+        self._loop_in = None
+        self._loop_out = None
+        self.emit("loop-changed")
+
     def get_cel(self, frame_idx=None, layer_idx=None):
         if frame_idx is None:
             frame_idx = self.current_frame
@@ -222,7 +498,12 @@ class XSheet(GObject.GObject):
             layer_idx = self.layer_idx
 
         if not self.layers[layer_idx].has_cel_at(frame_idx):
+            entries = self.layers[layer_idx].get_entries(frame_idx,
+                                                         frame_idx + 1)
             self.layers[layer_idx][frame_idx] = Cel()
+            self._push_entries_edit(layer_idx, frame_idx, frame_idx + 1,
+                                    entries, self._edit_cel)
+            self._record('add_cel', frame_idx, layer_idx)
             self._emit_signals(frame_changed=True)
 
     def remove_clear(self, frame_idx=None, layer_idx=None):
@@ -232,7 +513,11 @@ class XSheet(GObject.GObject):
         if layer_idx is None:
             layer_idx = self.layer_idx
 
+        entries = self.layers[layer_idx].get_entries(frame_idx, frame_idx + 1)
         self.layers[layer_idx].remove_clear(frame_idx)
+        self._push_entries_edit(layer_idx, frame_idx, frame_idx + 1, entries,
+                                self._edit_cel)
+        self._record('remove_clear', frame_idx, layer_idx)
         self._emit_signals(frame_changed=True)
 
     def cut(self, frame_idx=None, layer_idx=None):
@@ -244,8 +529,13 @@ class XSheet(GObject.GObject):
 
         cel = self.get_cel(frame_idx, layer_idx)
         assert cel is not None
+        entries = self.layers[layer_idx].get_entries(frame_idx, frame_idx + 1)
+        edit_cel = self._edit_cel
         self._edit_cel = cel
         del self.layers[layer_idx][frame_idx]
+        self._push_entries_edit(layer_idx, frame_idx, frame_idx + 1, entries,
+                                edit_cel)
+        self._record('cut', frame_idx, layer_idx)
 
         self._emit_signals(frame_changed=True)
 
@@ -259,6 +549,7 @@ class XSheet(GObject.GObject):
         cel = self.get_cel(frame_idx, layer_idx)
         assert cel is not None
         self._edit_cel = cel.copy()
+        self._record('copy', frame_idx, layer_idx)
 
     def paste(self, frame_idx=None, layer_idx=None):
         if frame_idx is None:
@@ -268,12 +559,269 @@ class XSheet(GObject.GObject):
             layer_idx = self.layer_idx
 
         assert self._edit_cel is not None
+        entries = self.layers[layer_idx].get_entries(frame_idx, frame_idx + 1)
+        edit_cel = self._edit_cel
         self.layers[layer_idx][frame_idx] = self._edit_cel
         self._edit_cel = None
+        self._push_entries_edit(layer_idx, frame_idx, frame_idx + 1, entries,
+                                edit_cel)
+        self._record('paste', frame_idx, layer_idx)
 
         self._emit_signals(frame_changed=True)
 
+    def insert_frames(self, length=1, frame_idx=None, layer_idx=None):
+        if frame_idx is None:
+            frame_idx = self.current_frame
+
+        if layer_idx is None:
+            layer_idx = self.layer_idx
+
+        layer = self.layers[layer_idx]
+        layer.insert_frames(frame_idx, length)
+        self.history.push(CallbackEdit(
+            lambda: layer.delete_frames(frame_idx, length),
+            lambda: layer.insert_frames(frame_idx, length),
+            scope=(layer_idx, frame_idx, None)))
+        self._record('insert_frames', length, frame_idx, layer_idx)
+        self._emit_signals(frame_changed=True)
+
+    def delete_frames(self, length=1, frame_idx=None, layer_idx=None):
+        if frame_idx is None:
+            frame_idx = self.current_frame
+
+        if layer_idx is None:
+            layer_idx = self.layer_idx
+
+        layer = self.layers[layer_idx]
+        # A cel held past the deleted frames is assigned again after
+        # them, so undoing removes that frame too.
+        last = frame_idx + length
+        if layer.has_repeat_at(last):
+            last += 1
+        removed = layer.delete_frames(frame_idx, length)
+
+        def undo():
+            layer.insert_frames(frame_idx, length)
+            layer.set_entries(frame_idx, last, removed)
+
+        self.history.push(CallbackEdit(
+            undo, lambda: layer.delete_frames(frame_idx, length),
+            _ENTRY_SIZE * len(removed), (layer_idx, frame_idx, None)))
+        self._record('delete_frames', length, frame_idx, layer_idx)
+        self._emit_signals(frame_changed=True)
+
+    def scale_timing(self, factor, frame_idx=None, layer_idx=None):
+        if frame_idx is None:
+            frame_idx = self.current_frame
+
+        if layer_idx is None:
+            layer_idx = self.layer_idx
+
+        entries = self.layers[layer_idx].get_entries(frame_idx)
+        self.layers[layer_idx].scale_timing(factor, frame_idx)
+        self._push_entries_edit(layer_idx, frame_idx, None, entries,
+                                self._edit_cel)
+        self._record('scale_timing', factor, frame_idx, layer_idx)
+        self._emit_signals(frame_changed=True)
+
+    def push_stroke(self, cel, old_buffer, tiles):
+        # Only the tiles that the stroke touched are compared.
+        if not tiles:
+            return
+
+        regions_before, regions_after = cel.get_changed_regions(old_buffer,
+                                                                tiles)
+        if regions_before:
+            self.history.push(StrokeEdit(cel, regions_before, regions_after))
+
+    def _push_entries_edit(self, layer_idx, first, last, entries_before,
+                           edit_cel_before):
+        # Only the assigned frames in the edited range are kept, and the
+        # cel being cut or pasted.
+        layer = self.layers[layer_idx]
+        entries_after = layer.get_entries(first, last)
+        edit_cel_after = self._edit_cel
+
+        def undo():
+            layer.set_entries(first, last, entries_before)
+            self._edit_cel = edit_cel_before
+
+        def redo():
+            layer.set_entries(first, last, entries_after)
+            self._edit_cel = edit_cel_after
+
+        size = _ENTRY_SIZE * (len(entries_before) + len(entries_after))
+        self.history.push(CallbackEdit(undo, redo, size,
+                                       (layer_idx, first, last)))
+
+    def undo(self):
+        edit = self.history.undo_edit
+        if edit is None:
+            return False
+
+        cel_refs = self._get_cel_refs()
+        self.history.undo()
+        self._record_restore(edit, cel_refs, undone=True)
+        self._emit_signals(frame_changed=True)
+        return True
+
+    def redo(self):
+        edit = self.history.redo_edit
+        if edit is None:
+            return False
+
+        cel_refs = self._get_cel_refs()
+        self.history.redo()
+        self._record_restore(edit, cel_refs, undone=False)
+        self._emit_signals(frame_changed=True)
+        return True
+
+    def _get_cel_refs(self):
+        # Where each cel is before an undo or redo, so the journal can
+        # point at it when replayed.
+        cel_refs = {}
+        if self.journal is None:
+            return cel_refs
+
+        for layer_idx, layer in enumerate(self.layers):
+            for frame_idx, next_frame_idx, cel in layer.get_content_runs():
+                if cel is not None and cel not in cel_refs:
+                    cel_refs[cel] = ['sheet', layer_idx, frame_idx]
+        if self._edit_cel is not None and self._edit_cel not in cel_refs:
+            cel_refs[self._edit_cel] = ['clipboard']
+        return cel_refs
+
+    def _get_cel_ref(self, cel, cel_refs, new_cels):
+        # A cel that only the history kept is recorded whole.
+        if cel is None:
+            return None
+
+        if cel not in cel_refs:
+            cel_refs[cel] = ['new', len(new_cels)]
+            regions = [(x, y, TILE_SIZE, TILE_SIZE, pixels) for x, y, pixels
+                       in _get_buffer_tiles(cel.gegl_surface.get_buffer())]
+            new_cels.append({'extent': cel.extent_to_data(),
+                             'regions': _encode_regions(regions)})
+        return cel_refs[cel]
+
+    def _record_restore(self, edit, cel_refs, undone):
+        if self.journal is None:
+            return
+
+        if isinstance(edit, StrokeEdit):
+            # A cel out of the sheet and the clipboard is recorded
+            # whole, with these regions, if it ever comes back.
+            if edit.cel not in cel_refs:
+                return
+            regions = edit.regions_before if undone else edit.regions_after
+            self.journal.record_data('restore_regions', {
+                'cel': cel_refs[edit.cel],
+                'regions': _encode_regions(regions),
+            })
+            return
+
+        layer_idx, first, last = edit.scope
+        new_cels = []
+        entries = [[frame_idx, self._get_cel_ref(cel, cel_refs, new_cels)]
+                   for frame_idx, cel
+                   in self.layers[layer_idx].get_entries(first, last)]
+        edit_cel = self._get_cel_ref(self._edit_cel, cel_refs, new_cels)
+        self.journal.record_data('restore_entries', {
+            'layer': layer_idx,
+            'first': first,
+            'last': last,
+            'entries': entries,
+            'edit_cel': edit_cel,
+            'cels': new_cels,
+        })
+
+    def _resolve_cel_ref(self, cel_ref, new_cels):
+        if cel_ref is None:
+            return None
+        if cel_ref[0] == 'sheet':
+            return self.layers[cel_ref[1]][cel_ref[2]]
+        if cel_ref[0] == 'clipboard':
+            return self._edit_cel
+        return new_cels[cel_ref[1]]
+
+    def restore_entries(self, data):
+        # Replays an undo or redo from the journal.  The history is
+        # left alone.
+        new_cels = []
+        for cel_data in data['cels']:
+            cel = Cel()
+            cel.extent_from_data(cel_data['extent'])
+            cel.set_regions(_decode_regions(cel_data['regions']))
+            new_cels.append(cel)
+
+        entries = [(frame_idx, self._resolve_cel_ref(cel_ref, new_cels))
+                   for frame_idx, cel_ref in data['entries']]
+        edit_cel = self._resolve_cel_ref(data['edit_cel'], new_cels)
+        self.layers[data['layer']].set_entries(data['first'], data['last'],
+                                               entries)
+        self._edit_cel = edit_cel
+        self._emit_signals(frame_changed=True)
+
+    def restore_regions(self, data):
+        cel = self._resolve_cel_ref(data['cel'], [])
+        cel.set_regions(_decode_regions(data['regions']))
+        cel.mark_dirty()
+        self._emit_signals(frame_changed=True)
+
+    def _record(self, name, *args):
+        if self.journal is not None:
+            self.journal.record_edit(name, *args)
+
+    def freeze(self):
+        self._freeze_count += 1
+
+    def thaw(self):
+        assert self._freeze_count > 0
+        self._freeze_count -= 1
+        if self._freeze_count == 0:
+            self._emit_signals()
+
+    @contextlib.contextmanager
+    def frozen(self):
+        self.freeze()
+        try:
+            yield
+        finally:
+            self.thaw()
+
     def _emit_signals(self, frame_changed=False, layer_changed=False):
+        # The changes are accumulated, so while frozen, or when
+        # coalescing, the handlers run once with the final state.
+        if frame_changed:
+            self._pending_signals['frame-changed'] = True
+        if layer_changed:
+            self._pending_signals['layer-changed'] = True
+
+        if self._freeze_count > 0:
+            return
+
+        if self.coalesce_signals:
+            # High idle priority runs before GTK redraws, so the views
+            # are updated at most once per main loop iteration.
+            if self._flush_hid is None:
+                self._flush_hid = GLib.idle_add(
+                    self._flush_signals_cb, priority=GLib.PRIORITY_HIGH_IDLE)
+            return
+
+        self._flush_signals()
+
+    def _flush_signals_cb(self):
+        self._flush_hid = None
+        if self._freeze_count == 0:
+            self._flush_signals()
+        return False
+
+    def _flush_signals(self):
+        frame_changed = self._pending_signals['frame-changed']
+        layer_changed = self._pending_signals['layer-changed']
+        self._pending_signals['frame-changed'] = False
+        self._pending_signals['layer-changed'] = False
+
         if frame_changed:
             self.emit("frame-changed")
         if layer_changed:
@@ -281,70 +829,226 @@ class XSheet(GObject.GObject):
         if frame_changed or layer_changed:
             self.emit("cursor-changed")
 
-    def _get_cel_path(self, layer_idx, frame_idx, extension):
-        return "cels/{0}-{1}.{2}".format(str(layer_idx).zfill(3),
-                                         str(frame_idx).zfill(6),
-                                         extension)
-
-    def _get_data(self):
-        data = []
-        for layer_idx, layer in enumerate(self.layers):
+    def _get_data(self, layers, cel_tiles, loop_markers, fps,
+                  journal_position):
+        layers_data = []
+        for layer in layers:
             layer_data = {}
-            for frame_idx in layer.get_assigned_frames():
+            for frame_idx, cel, extent in layer:
                 frame_data = {}
-                frame_type = layer.get_type_at(frame_idx)
-                frame_data['type'] = frame_type
-                if frame_type == 'cel':
-                    png_path = self._get_cel_path(layer_idx, frame_idx, 'png')
-                    frame_data['path'] = png_path
-                    cel = layer[frame_idx]
-                    frame_data['extent'] = cel.extent_to_data()
+                if cel is not None:
+                    frame_data['type'] = 'cel'
+                    frame_data['extent'] = extent
+                    frame_data['tiles'] = cel_tiles[cel]
+                else:
+                    frame_data['type'] = 'clear'
                 layer_data[frame_idx] = frame_data
-            data.append(layer_data)
-
-        return data
+            layers_data.append(layer_data)
+
+        return {
+            'version': FORMAT_VERSION,
+            'tile_size': TILE_SIZE,
+            'layers': layers_data,
+            'loop': list(loop_markers),
+            'fps': str(fps),
+            'journal': journal_position,
+        }
+
+    def _take_snapshot(self):
+        # The buffer of a modified cel is duplicated, which is cheap
+        # because GEGL shares the tiles until the cel is drawn again.
+        # Unmodified cels keep the tiles of the archive they were
+        # saved to.
+        layers = []
+        cels = []
+        seen_cels = set()
+        for layer in self.layers:
+            layer_snapshot = []
+            for frame_idx, next_frame_idx, cel in layer.get_content_runs():
+                if cel is None:
+                    layer_snapshot.append((frame_idx, None, None))
+                    continue
+
+                layer_snapshot.append((frame_idx, cel, cel.extent_to_data()))
+                if cel in seen_cels:
+                    continue
+                seen_cels.add(cel)
+
+                if not cel.dirty and cel.archive_tiles is not None:
+                    cels.append((cel, cel.revision, None, cel.archive,
+                                 list(cel.archive_tiles)))
+                else:
+                    cels.append((cel, cel.revision, cel.snapshot_buffer(),
+                                 None, None))
+            layers.append(layer_snapshot)
+
+        journal_position = None
+        if self.journal is not None:
+            journal_position = (self.journal.generation,
+                                self.journal.get_position())
+
+        return {
+            'layers': layers,
+            'cels': cels,
+            'journal_position': journal_position,
+            'loop_markers': self.loop_markers,
+            'fps': self.fps,
+        }
+
+    def _write_snapshot(self, snapshot, filename, workers=None,
+                        progress_cb=None):
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+
+        def encode(entry):
+            cel, revision, cel_buffer, archive, archive_tiles = entry
+            if cel_buffer is None:
+                return [(x, y, tile_hash, None)
+                        for x, y, tile_hash in archive_tiles]
+            return [(x, y) + _encode_tile(pixels)
+                    for x, y, pixels in _get_buffer_tiles(cel_buffer)]
 
-    def save(self, filename):
-        tempdir = tempfile.mkdtemp('xsheet')
         xsheet_zip = zipfile.ZipFile(filename + '.tmpsave', 'w',
                                      compression=zipfile.ZIP_STORED)
 
-        for layer_idx, layer in enumerate(self.layers):
-            for frame_idx in layer.get_assigned_frames():
-                frame_type = layer.get_type_at(frame_idx)
-                if frame_type == 'cel':
-                    cel = layer[frame_idx]
-                    png_path = self._get_cel_path(layer_idx, frame_idx, 'png')
-                    temp_png_path = os.path.join(tempdir, 'cel.png')
-                    cel.save_png(temp_png_path)
-                    xsheet_zip.write(temp_png_path, png_path)
-                    os.remove(temp_png_path)
-
-        path_data = os.path.join(tempdir, 'info.json')
-        data = self._get_data()
-        with open(path_data, 'w') as datafile:
-            json.dump(data, datafile, sort_keys=True, indent=2)
-
-        xsheet_zip.write(path_data, 'info.json')
-        os.remove(path_data)
+        # Identical tiles are stored once, named by their hash.
+        written_tiles = set()
+        cel_tiles = {}
+        entries = snapshot['cels']
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            encoded = executor.map(encode, entries)
+            for done, (entry, tiles) in enumerate(zip(entries, encoded)):
+                cel, revision, cel_buffer, archive, archive_tiles = entry
+                tiles_data = []
+                for x, y, tile_hash, tile_data in tiles:
+                    tile_path = _get_tile_path(tile_hash)
+                    if tile_hash not in written_tiles:
+                        if tile_data is None:
+                            tile_data = archive.read(tile_path)
+                        xsheet_zip.writestr(tile_path, tile_data)
+                        written_tiles.add(tile_hash)
+                    tiles_data.append([x, y, tile_hash])
+                cel_tiles[cel] = tiles_data
+
+                if progress_cb is not None:
+                    progress_cb(done + 1, len(entries))
+
+        data = self._get_data(snapshot['layers'], cel_tiles,
+                              snapshot['loop_markers'], snapshot['fps'],
+                              snapshot['journal_position'])
+        xsheet_zip.writestr('info.json',
+                            json.dumps(data, sort_keys=True, indent=2))
 
         xsheet_zip.close()
-        os.rmdir(tempdir)
-        if os.path.exists(filename):
-            os.remove(filename)
-        os.rename(filename + '.tmpsave', filename)
+        os.replace(filename + '.tmpsave', filename)
+
+        return cel_tiles
+
+    def _finish_save(self, snapshot, filename, cel_tiles):
+        # Cels drawn while saving stay modified for the next save.
+        archive = Archive(filename)
+        for cel, revision, cel_buffer, old_archive, archive_tiles in \
+                snapshot['cels']:
+            if cel.revision == revision:
+                cel.set_archived(archive, tiles=cel_tiles[cel])
+
+        if (self.journal is not None and
+                snapshot['journal_position'] is not None):
+            generation, position = snapshot['journal_position']
+            self.journal.truncate(position)
+
+    def save(self, filename, workers=None):
+        self.wait_save()
+        snapshot = self._take_snapshot()
+        cel_tiles = self._write_snapshot(snapshot, filename, workers)
+        self._finish_save(snapshot, filename, cel_tiles)
+
+    def save_async(self, filename, workers=None):
+        if self._save_job is not None:
+            return False
+
+        job = {
+            'snapshot': self._take_snapshot(),
+            'filename': filename,
+            'cel_tiles': None,
+            'finished': False,
+        }
+
+        def progress_cb(done, total):
+            GLib.idle_add(self.emit, "save-progress", done, total)
+
+        def write():
+            try:
+                job['cel_tiles'] = self._write_snapshot(
+                    job['snapshot'], filename, workers, progress_cb)
+            except Exception:
+                traceback.print_exc()
+            GLib.idle_add(self._save_done_cb, job)
+
+        job['thread'] = threading.Thread(target=write)
+        self._save_job = job
+        job['thread'].start()
+        return True
+
+    @property
+    def is_saving(self):
+        return self._save_job is not None
+
+    def wait_save(self):
+        if self._save_job is None:
+            return False
+
+        job = self._save_job
+        job['thread'].join()
+        self._save_done_cb(job)
+        return True
+
+    def _save_done_cb(self, job):
+        if job['finished']:
+            return False
+
+        job['finished'] = True
+        self._save_job = None
+
+        success = job['cel_tiles'] is not None
+        if success:
+            self._finish_save(job['snapshot'], job['filename'],
+                              job['cel_tiles'])
+        self.emit("save-finished", success)
+        return False
 
     def new(self, layers_length=3):
         self._setup(layers_length)
+        self._record('new', layers_length)
         self._emit_signals(frame_changed=True, layer_changed=True)
-
-    def load(self, filename):
-        tempdir = tempfile.mkdtemp('xsheet')
-        xsheet_zip = zipfile.ZipFile(filename)
-
-        data = json.loads(xsheet_zip.read('info.json'))
-        self._setup(len(data))
-        for layer_idx, layer_data in enumerate(data):
+        self.emit("loop-changed")
+
+    def load(self, filename, parallel=False, workers=None):
+        archive = Archive(filename)
+        data = json.loads(bytes(archive.read('info.json')).decode('utf-8'))
+
+        # The first format version was a plain list of layers.
+        loop_markers = (None, None)
+        fps = DEFAULT_FPS
+        journal_position = None
+        if isinstance(data, list):
+            layers_data = data
+        else:
+            if data['version'] > FORMAT_VERSION:
+                raise ValueError("Unsupported format version {0}".format(
+                    data['version']))
+            if data['tile_size'] != TILE_SIZE:
+                raise ValueError("Unsupported tile size {0}".format(
+                    data['tile_size']))
+            layers_data = data['layers']
+            loop_markers = data.get('loop', loop_markers)
+            fps = Fraction(data.get('fps', fps))
+            journal_position = data.get('journal')
+
+        # Cels are decoded the first time their pixels are needed, or
+        # in the background if parallel is True.
+        self._setup(len(layers_data))
+        for layer_idx, layer_data in enumerate(layers_data):
             for frame_idx, frame_data in layer_data.items():
                 frame_idx = int(frame_idx)
                 if frame_data['type'] == 'clear':
@@ -354,29 +1058,92 @@ class XSheet(GObject.GObject):
                     self.layers[layer_idx][frame_idx] = cel
                     extent = frame_data['extent']
                     cel.extent_from_data(extent)
-                    png_path = frame_data['path']
-                    temp_png_path = os.path.join(tempdir, 'cel.png')
-                    png_file = open(temp_png_path, 'wb')
-                    png_file.write(xsheet_zip.read(png_path))
-                    png_file.close()
-                    cel.load_png(temp_png_path)
-                    os.remove(temp_png_path)
+                    if 'tiles' in frame_data:
+                        cel.set_archived(archive, tiles=frame_data['tiles'])
+                    else:
+                        cel.set_archived(archive, path=frame_data['path'])
+                    cel.defer_decode()
 
-        xsheet_zip.close()
-        os.rmdir(tempdir)
+        self._loop_in, self._loop_out = loop_markers
+        self.fps = fps
+        self.saved_journal_position = journal_position
 
-        self._emit_signals(frame_changed=True, layer_changed=True)
+        for layer in self.layers:
+            cel = layer[self.current_frame]
+            if cel is not None:
+                cel.decode()
 
-    def _get_first_frame(self):
-        first_frames = [layer.get_first_frame() for layer in self.layers]
-        valid_frames = [frame for frame in first_frames if frame is not None]
-        if not valid_frames:
-            return 0
-        return min(valid_frames)
-
-    def _get_last_frame(self):
-        last_frames = [layer.get_last_frame() for layer in self.layers]
-        valid_frames = [frame for frame in last_frames if frame is not None]
-        if not valid_frames:
-            return 0
-        return max(valid_frames)
+        self._emit_signals(frame_changed=True, layer_changed=True)
+        self.emit("loop-changed")
+
+        if parallel:
+            self._start_decoding(workers)
+
+    def _start_decoding(self, workers=None):
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+
+        cels = []
+        for layer in self.layers:
+            for frame_idx, next_frame_idx, cel in layer.get_content_runs():
+                if cel is not None and not cel.is_decoded:
+                    cels.append(cel)
+
+        if not cels:
+            return
+
+        def decode(cel):
+            return cel, cel.read_archived_regions()
+
+        decoded = queue.Queue()
+        executor = ThreadPoolExecutor(max_workers=workers)
+        futures = []
+        for cel in cels:
+            future = executor.submit(decode, cel)
+            future.add_done_callback(decoded.put)
+            futures.append(future)
+
+        self._decode_job = {
+            'executor': executor,
+            'futures': futures,
+            'queue': decoded,
+            'done': 0,
+            'total': len(cels),
+        }
+        self._decode_job['hid'] = GObject.timeout_add(
+            DECODE_BATCH_INTERVAL, self._decode_batch_cb)
+
+    def _decode_batch_cb(self):
+        job = self._decode_job
+        while True:
+            try:
+                future = job['queue'].get_nowait()
+            except queue.Empty:
+                break
+            # A cel that fails to decode here is left to decode when
+            # it is first drawn.
+            try:
+                cel, regions = future.result()
+                cel.decode(regions)
+            except Exception:
+                traceback.print_exc()
+            job['done'] += 1
+
+        self.emit("load-progress", job['done'], job['total'])
+
+        if job['done'] < job['total']:
+            return True
+
+        job['executor'].shutdown(wait=False)
+        self._decode_job = None
+        return False
+
+    def _stop_decoding(self):
+        if self._decode_job is None:
+            return
+
+        GObject.source_remove(self._decode_job['hid'])
+        for future in self._decode_job['futures']:
+            future.cancel()
+        self._decode_job['executor'].shutdown(wait=False)
+        self._decode_job = None
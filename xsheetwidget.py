@@ -78,6 +78,7 @@ class _XSheetDrawing(Gtk.DrawingArea):
         self.connect("scroll-event", self._scroll_cb)
 
         self._xsheet.connect('cursor-changed', self._xsheet_changed_cb)
+        self._xsheet.connect('loop-changed', self._loop_changed_cb)
         self._adjustment.connect("value-changed", self._scroll_changed_cb)
 
         widget_width = NUMBERS_WIDTH + CEL_WIDTH * self._xsheet.layers_length
@@ -117,6 +118,9 @@ class _XSheetDrawing(Gtk.DrawingArea):
 
         self.queue_draw()
 
+    def _loop_changed_cb(self, xsheet):
+        self.queue_draw()
+
     def _update_offset(self):
         dy = self.virtual_height - self.get_allocated_height()
         dx = self._adjustment.props.upper - self._adjustment.props.page_size
@@ -152,6 +156,7 @@ class _XSheetDrawing(Gtk.DrawingArea):
         self._draw_grid(drawing_context)
         self._draw_numbers(drawing_context)
         self._draw_elements(drawing_context)
+        self._draw_loop_markers(drawing_context)
 
         context.set_source_surface(self._pixbuf, 0, 0)
         context.paint()
@@ -367,23 +372,41 @@ class _XSheetDrawing(Gtk.DrawingArea):
         context.set_line_width(STRONG_LINE_WIDTH * 10)
         context.set_source_rgb(*self._fg_grey_color)
 
+        first = self._first_visible_frame
+        last = self._last_visible_frames
+
         for layer_idx in range(self._xsheet.layers_length):
             layer = self._xsheet.get_layers()[layer_idx]
-            for start, end in layer.get_extremes():
+            # An extreme cleared on the first visible frame still
+            # draws its end there.
+            for start, end in layer.get_extremes(first - 1, last + 1):
                 self._draw_cels_line(context, layer_idx, start, end)
 
-        first = self._first_visible_frame
-        last = self._last_visible_frames
-
         for layer_idx in range(self._xsheet.layers_length):
             layer = self._xsheet.get_layers()[layer_idx]
-            for frame in range(first, last):
-                if layer.get_type_at(frame) == 'repeat clear':
-                    continue
-                elif layer.get_type_at(frame) == 'clear':
-                    self._draw_clear(context, layer_idx, frame)
-                elif layer.get_type_at(frame) == 'cel':
-                    self._draw_cel(context, layer_idx, frame)
+            for start, end, frame_type in layer.get_type_runs(first, last):
+                if frame_type == 'clear':
+                    self._draw_clear(context, layer_idx, start)
+                elif frame_type == 'cel':
+                    self._draw_cel(context, layer_idx, start)
+
+    def _draw_loop_markers(self, context):
+        loop_in, loop_out = self._xsheet.loop_markers
+
+        context.set_line_width(SECONDS_LINE_WIDTH * 3)
+        context.set_source_rgb(*self._fg_color)
+
+        if loop_in is not None:
+            y = loop_in * CEL_HEIGHT * self._zoom_factor
+            context.move_to(0, y)
+            context.line_to(NUMBERS_WIDTH, y)
+            context.stroke()
+
+        if loop_out is not None:
+            y = (loop_out + 1) * CEL_HEIGHT * self._zoom_factor
+            context.move_to(0, y)
+            context.line_to(NUMBERS_WIDTH, y)
+            context.stroke()
 
     def _get_frame_from_point(self, x, y):
         return int((y - self._offset) / CEL_HEIGHT / self._zoom_factor)